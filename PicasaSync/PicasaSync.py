@@ -4,7 +4,7 @@ import sys
 #if sys.hexversion < 0x020700F0:
 #    raise SystemExit('This scripts needs at least Python 2.7')
 
-import logging, os, mimetypes, argparse, urllib, multiprocessing, threading, calendar, re, cStringIO, itertools
+import logging, os, time, mimetypes, argparse, multiprocessing, threading, functools, collections, sqlite3, hashlib, shutil, httplib, socket, Queue
 
 try:
     import googlecl
@@ -40,46 +40,83 @@ if hasattr(mimetypes, '_db') and hasattr(mimetypes._db, 'types_map_inv') and mim
     mimetypes._db.types_map_inv[True]['image/jpeg'].remove('.jpe')
 
 from dryrun import dryrun
+import transfer
+from state import StateStore
+from scheduler import Scheduler, TaskGroup
+from transform import Transformer, TransformError
+from thumbnails import ThumbnailFetcher
+from scanner import DiskScanner
+from metrics import metrics
+from throttle import Throttle
+from remote import RemotePhoto
+from feed import FeedReader, album_from_element
+from prefetch import FeedPrefetcher
+from export import Exporter
+from batch import MetadataBatch
+import exifdate
+import filedate
+
+# What an API call can fail with, the connection as well as the server
+API_ERRORS = (GooglePhotosException, httplib.HTTPException, socket.error)
 
 def _entry_ts(entry):
     return int(long(entry.timestamp.text) / 1000)
 
+def _add_album(albums, album):
+    if album.title in albums:
+        try:
+            albums[album.title].combine(album)
+        except InvalidArguments as e:
+            # Two albums of that title on the same side, only the first one
+            # is synced and it is not recorded as synced
+            album.LOG.error(e)
+            albums[album.title].error(e)
+    else:
+        albums[album.title] = album
+
 class InvalidArguments(Exception): pass
 
 class PhotoDiskEntry(object):
-    def __init__(self, cl_args, path, album_path = None):
+    def __init__(self, cl_args, path, album_path = None, index = None, st = None, mimetype = None):
         path = googlecl.safe_decode(path)
         self.path = path
+        self.mimetype = mimetype or mimetypes.guess_type(path)[0]
         self.timestamp = None
+        self.origin = None
+        self.mtime = None
         if album_path:
             path = os.path.join(album_path, path)
         if 'stat' not in cl_args.origin:
             cl_args.origin.append('stat')
+        if st is None:
+            try:
+                st = os.stat(path)
+            except Exception:
+                return
+        self.mtime = st.st_mtime
+        if index:
+            path = os.path.abspath(path)
+            cached = index.lookup_scan(path, st, cl_args.origin)
+            if cached:
+                self.timestamp, self.origin = cached
+                return
         for origin in cl_args.origin:
             if origin == 'stat':
-                try:
-                    self.timestamp = int(os.stat(path).st_mtime)
-                    break
-                except Exception:
-                    pass
+                self.timestamp = int(st.st_mtime)
+                self.origin = origin
+                break
             elif origin == 'exif':
-                metadata = pyexiv2.ImageMetadata(path)
-                try:
-                    metadata.read()
-                    if 'Exif.Image.DateTime' in metadata:
-                        self.timestamp = calendar.timegm(metadata['Exif.Image.DateTime'].value.timetuple())
-                        break
-                except Exception:
-                    pass
+                self.timestamp = exifdate.timestamp(path)
+                if self.timestamp:
+                    self.origin = origin
+                    break
             else:
-                for m in re.finditer(r'\d', self.path):
-                    try:
-                        self.timestamp = calendar.timegm(dateutil.parser.parse(m.string[m.start():], fuzzy = True, dayfirst = True).timetuple())
-                        break
-                    except ValueError:
-                        pass
+                self.timestamp = filedate.timestamp(self.path)
                 if self.timestamp:
+                    self.origin = origin
                     break
+        if index:
+            index.store_scan(path, st, cl_args.origin, self.timestamp, self.origin)
 
 class AlbumDiskEntry(object):
     def __init__(self, cl_args, path):
@@ -95,38 +132,24 @@ class AlbumDiskEntry(object):
                 except Exception:
                     pass
             elif origin == 'filename':
-                for m in re.finditer(r'\d', self.path):
-                    try:
-                        self.timestamp = calendar.timegm(dateutil.parser.parse(m.string[m.start():], fuzzy = True, dayfirst = True).timetuple())
-                        break
-                    except ValueError:
-                        pass
+                self.timestamp = filedate.cached_timestamp(self.path)
                 if self.timestamp:
                     break
 
 class Photo(object):
     LOG = logging.getLogger('Photo')
-    transforms = {
-            1 : (),
-            2 : (Image.FLIP_LEFT_RIGHT,),
-            3 : (Image.ROTATE_180,),
-            4 : (Image.FLIP_TOP_BOTTOM,),
-            5 : (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
-            6 : (Image.ROTATE_270,),
-            7 : (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
-            8 : (Image.ROTATE_90,)
-            }
 
     def __init__(self, album, title = None, disk = None, picasa = None, raw = False):
         self.album = album
         self.disk = disk
         self.picasa = picasa
         self.raw = raw
+        self.order_id = None
         if not title:
             if disk:
                 self.title = os.path.splitext(disk.path)[0]
             elif picasa:
-                self.title = picasa.title.text
+                self.title = picasa.title
             else:
                 raise InvalidArguments("No title for photo given and no valid entry found")
         else:
@@ -139,6 +162,12 @@ class Photo(object):
             return os.path.join(self.album.disk.path, self.disk.path)
         return property(**locals())
 
+    @apply
+    def thumbnail_path():
+        def fget(self):
+            return 'thumbnail/' + self.path
+        return property(**locals())
+
     def combine(self, other):
         if self.isInDisk() and not other.isInDisk() and other.isInPicasa():
             self.picasa = other.picasa
@@ -156,19 +185,64 @@ class Photo(object):
     def isRaw(self):
         return self.raw
 
-    @dryrun('self.album.cl_args.dry_run', LOG, u'Uploading file "{self.disk.path}"{reason}')
+    def contentHash(self):
+        if not self.album.state:
+            return None
+        try:
+            return self.album.state.content_hash(self.path)
+        except EnvironmentError:
+            return None
+
+    def remoteSize(self):
+        return self.picasa.size
+
+    def isUnchanged(self):
+        sha1 = self.contentHash()
+        if not sha1:
+            return False
+        if self.picasa.checksum == sha1:
+            return True
+        return self.album.state.lookup_photo(self.path) == (self.picasa.id, sha1, self.remoteSize())
+
+    def setRemote(self, entry):
+        self.picasa = RemotePhoto.from_entry(entry)
+        self.picasa.title = self.title
+
+    def recordSynced(self):
+        if not (self.album.cl_args.content_hash and self.isInDisk() and self.isInPicasa()):
+            return
+        sha1 = self.contentHash()
+        if sha1:
+            self.album.state.store_photo(self.path, self.picasa.id, sha1, self.remoteSize())
+
+    @dryrun('self.album.cl_args.dry_run', LOG, u'Uploading file "{self.disk.path}"{reason}', phase = 'upload')
     def upload(self):
+        if self.isInPicasa() and self.album.batch and self.album.cl_args.force_update == 'metadata':
+            # Sent with the rest of the album's updates once it is done
+            self.album.batch.add(self)
+            return
+        planned = self.album.record('upload', self.path, self.picasa and self.picasa.id)
         if self.isInPicasa():
+            # Only the compact record is kept, the entry is needed to update
+            try:
+                entry = self.album.client.GetEntry(self.picasa.edit_link)
+            except API_ERRORS as e:
+                self.LOG.error(u'Error reading photo "{0}": '.format(self.title) + str(e))
+                self.album.error(e)
+                return
             if self.album.cl_args.force_update and self.album.cl_args.force_update == 'metadata':
-                self.picasa.timestamp = gdata.photos.Timestamp(text = str(long(self.disk.timestamp) * 1000))
+                entry.timestamp = gdata.photos.Timestamp(text = str(long(self.disk.timestamp) * 1000))
                 try:
-                    self.picasa = self.album.client.UpdatePhotoMetadata(self.picasa)
+                    self.setRemote(self.album.client.UpdatePhotoMetadata(entry))
                 except GooglePhotosException as e:
                     self.LOG.error(u'Error updating metadata for photo "{0}": '.format(self.title) + str(e))
+                    self.album.error(e)
+                else:
+                    self.album.finish(planned)
                 finally:
                     return
             else:
-                metadata = self.picasa
+                metadata = entry
                 metadata.timestamp = gdata.photos.Timestamp(text = str(long(self.disk.timestamp) * 1000))
                 metadata.title = atom.Title(text = self.title)
         else:
@@ -176,135 +250,105 @@ class Photo(object):
             metadata.title = atom.Title(text = self.title)
             metadata.timestamp = gdata.photos.Timestamp(text = str(long(self.disk.timestamp) * 1000))
 
+        if self.album.cl_args.content_hash and self.contentHash():
+            metadata.checksum = gdata.photos.Checksum(text = self.contentHash())
+
         mimetype = mimetypes.guess_type(self.path)[0]
-        transforms = self.album.cl_args.transform[:] if self.album.cl_args.transform else None
-        if transforms:
-            original = pyexiv2.ImageMetadata(googlecl.safe_decode(self.path))
+        photo = self.path
+        if self.album.transformer:
+            # The digest only keys the derivative cache
+            digest = None
+            if self.album.cl_args.content_hash or self.album.transformer.cache:
+                digest = self.contentHash()
             try:
-                original.read()
-            except Exception as e:
-                self.LOG.error(u'Error reading file "{0}": '.format(self.disk.path) + str(e))
+                spooled, mimetype = self.album.transformer(self.path, self.isRaw(), digest)
+            except TransformError as e:
+                self.LOG.error(unicode(e))
+                self.album.error(e)
                 return
-
-            if 'raw' in transforms and not self.isRaw():
-                transforms.remove('raw')
-            if 'resize' in transforms and not (original.dimensions[0] > self.album.cl_args.max_size[0] or original.dimensions[1] > self.album.cl_args.max_size[1]):
-                transforms.remove('resize')
-            if 'rotate' in transforms and ('Exif.Image.Orientation' not in original or original['Exif.Image.Orientation'].value == 1):
-                transforms.remove('rotate')
-
-            if 'raw' in transforms:
-                if len(original.previews) == 0:
-                    self.LOG.error(u'Error getting valid preview from raw file "{0}"'.format(self.disk.path))
-                    return
-                try:
-                    preview = next(x for x in original.previews if (x.dimensions[0] >= self.album.cl_args.max_size[0] or x.dimensions[1] >= self.album.cl_args.max_size[1]) and x.mime_type in AlbumList.standard_types)
-                except StopIteration:
-                    preview = metadata.previews[-1]
-                mimetype = preview.mime_type
-                if mimetype not in AlbumList.standard_types:
-                    self.LOG.error(u'Error getting valid preview from raw file "{0}"'.format(self.disk.path))
-                    return
-                photo = cStringIO.StringIO(preview.data)
-            else:
-                photo = cStringIO.StringIO(original.buffer)
-#            if 'resize' in transforms or 'rotate' in transforms and mimetype != 'image/jpeg':
-            if 'resize' in transforms or 'rotate' in transforms:
-                image = Image.open(photo)
-                if 'resize' in transforms:
-                    image.thumbnail(self.album.cl_args.max_size, Image.ANTIALIAS)
-                if 'rotate' in transforms:
-                    for t in self.transforms.get(original['Exif.Image.Orientation'].value, ()):
-                        image = image.transpose(t)
-                    original['Exif.Image.Orientation'] = 1
-                photo = cStringIO.StringIO()
-                # TODO: save in the same format and size approx
-                image.save(photo, 'JPEG', quality = 95)
-                mimetype = 'image/jpeg'
-                photo.seek(0)
-#            if 'rotate' in transforms and 'resize' not in transforms and mimetype == 'image/jpeg':
-#                # TODO: lossless jpeg rotate
-#                pass
-            if not self.album.cl_args.strip_exif:
-                modified = pyexiv2.ImageMetadata.from_buffer(photo.getvalue())
-                modified.read()
-                original.copy(modified)
-                modified.write()
-                photo = cStringIO.StringIO(modified.buffer)
-        else:
-            if self.album.cl_args.strip_exif:
-                original = pyexiv2.ImageMetadata.from_buffer(file(self.path).read())
-                original.read()
-                for k in original.exif_keys + original.iptc_keys + original.xmp_keys:
-                    del original[k]
-                del original.comment
-                original.write()
-                photo = cStringIO.StringIO(original.buffer)
-            else:
-                photo = self.path
+            if spooled:
+                photo = spooled
         try:
             if self.isInPicasa():
                 metadata = self.album.client.UpdatePhotoMetadata(metadata)
-                self.picasa = self.album.client.UpdatePhotoBlob(metadata, photo, mimetype)
+                self.setRemote(self.album.client.UpdatePhotoBlob(metadata, photo, mimetype))
             else:
-                self.picasa = self.album.client.InsertPhoto(self.album.picasa, metadata, photo, mimetype)
-        except GooglePhotosException as e:
+                self.setRemote(self.album.client.InsertPhoto(self.album.picasa, metadata, photo, mimetype))
+        except API_ERRORS as e:
             self.LOG.error(u'Error uploading file "{0}": '.format(self.disk.path) + str(e))
+            self.album.error(e)
+        else:
+            metrics.count('bytes_up', os.path.getsize(photo))
+            metrics.count('photos_uploaded')
+            self.recordSynced()
+            self.album.finish(planned)
+        finally:
+            if photo != self.path:
+                self.album.transformer.release(photo)
 
-    @dryrun('self.album.cl_args.dry_run', LOG, u'Downloading photo "{self.title}"{reason}')
+    @dryrun('self.album.cl_args.dry_run', LOG, u'Downloading photo "{self.title}"{reason}', phase = 'download')
     def download(self):
-        timestamp = _entry_ts(self.picasa)
+        timestamp = self.picasa.timestamp
         if not self.disk:
-            self.disk = PhotoDiskEntry(self.album.cl_args, self.title + mimetypes.guess_extension(self.picasa.content.type), self.album.disk.path)
+            self.disk = PhotoDiskEntry(self.album.cl_args, self.title + mimetypes.guess_extension(self.picasa.mimetype), self.album.disk.path)
         if mimetypes.guess_type(self.path)[0] in AlbumList.raw_types:
             self.LOG.warn(u'Not overwriting RAW file "{0}"'.format(self.path))
             return
+        planned = self.album.record('download', self.path, self.picasa.id)
         tmpfilename = self.path + '.part'
         try:
-            urllib.urlretrieve(self.picasa.content.src, tmpfilename)
+            transfer.fetch(self.picasa.src, tmpfilename, self.album.cl_args.download_segments)
             os.utime(tmpfilename, (timestamp, timestamp))
             os.rename(tmpfilename, self.path)
         except EnvironmentError as e:
             self.LOG.error(u'Error downloading photo "{0}": '.format(self.title) + str(e))
+            self.album.error(e)
         else:
+            metrics.count('photos_downloaded')
             self.disk.timestamp = timestamp
+            self.recordSynced()
+            self.album.finish(planned)
 
     @dryrun('self.album.cl_args.dry_run', LOG, u'Downloading photo thumbnail "{self.title}"{reason}')
     def download_thumbnail(self):
-        try:
-            timestamp = _entry_ts(self.picasa)
-        except AttributeError as e:
-            self.LOG.error(str(e))
+        timestamp = self.picasa.timestamp
+        if len(self.picasa.thumbnails) < 2:
+            self.LOG.error(u'No thumbnail for photo "{0}"'.format(self.title))
             return
         if not self.disk:
             self.LOG.error("Disk object is None..")
             return
-        thumbnail_path = 'thumbnail/' + self.path
-        tmpfilename = thumbnail_path + '.part'
-        try:
-            urllib.urlretrieve(self.picasa.media.thumbnail[1].url, tmpfilename)
-            os.utime(tmpfilename, (timestamp, timestamp))
-            os.rename(tmpfilename, thumbnail_path)
-        except EnvironmentError as e:
-            self.LOG.error(u'Error downloading photo thumbnail "{0}": '.format(self.title) + str(e))
-        else:
-            self.disk.timestamp = timestamp
+        self.album.thumbnails.submit(self.picasa.thumbnails[1], self.thumbnail_path, timestamp, self.album,
+                functools.partial(setattr, self.disk, 'timestamp', timestamp))
+
+    def hasCurrentThumbnail(self):
+        if not self.disk:
+            return False
+        return ThumbnailFetcher.is_current(self.thumbnail_path, self.picasa.timestamp)
 
-    @dryrun('self.album.cl_args.dry_run', LOG, u'Deleting file "{self.disk.path}"{reason}')
+    @dryrun('self.album.cl_args.dry_run', LOG, u'Deleting file "{self.disk.path}"{reason}', phase = 'delete')
     def deleteFromDisk(self):
+        planned = self.album.record('remove', self.path)
         try:
             os.remove(self.path)
         except EnvironmentError as e:
             self.LOG.error(u'Cannot delete local file: ' + str(e))
+            self.album.error(e)
+        else:
+            self.album.finish(planned)
         finally:
             self.disk = None
 
-    @dryrun('self.album.cl_args.dry_run', LOG, u'Deleting photo "{self.title}"{reason}')
+    @dryrun('self.album.cl_args.dry_run', LOG, u'Deleting photo "{self.title}"{reason}', phase = 'delete')
     def deleteFromPicasa(self):
+        planned = self.album.record('delete', target = self.picasa.id)
         try:
-            self.album.client.Delete(self.picasa)
-        except GooglePhotosException as e:
+            self.album.client.Delete(self.picasa.edit_link)
+        except API_ERRORS as e:
             self.LOG.error(u'Error deleting photo "{0}": '.format(self.title) + str(e))
+            self.album.error(e)
+        else:
+            self.album.finish(planned)
         finally:
             self.picasa = None
 
@@ -319,19 +363,40 @@ class Photo(object):
                 self.deleteFromPicasa(reason = ' because it does not exist in the local album')
             if self.album.cl_args.download:
                 self.download(reason = ' because it does not exist in the local album')
-                self.download_thumbnail(reason = ' thumbnail')
+                if not self.hasCurrentThumbnail():
+                    self.download_thumbnail(reason = ' thumbnail')
         elif self.album.cl_args.update:
-            if self.album.cl_args.upload and (self.disk.timestamp > _entry_ts(self.picasa) or self.album.cl_args.force_update):
+            if self.album.cl_args.content_hash and not self.album.cl_args.force_update and (self.disk.timestamp == self.picasa.timestamp or self.isUnchanged()):
+                if self.disk.timestamp != self.picasa.timestamp:
+                    self.LOG.debug(u'Not updating photo "{0}" because its contents did not change'.format(self.title))
+                self.recordSynced()
+                return
+            if self.album.cl_args.upload and (self.disk.timestamp > self.picasa.timestamp or self.album.cl_args.force_update):
                 self.upload(reason = u' {0}because it is newer than the one in the album "{1.title}"'.format('[FORCED] ' if self.album.cl_args.force_update else '', self.album))
-            if self.album.cl_args.download and (self.disk.timestamp < _entry_ts(self.picasa) or self.album.cl_args.force_update):
+            if self.album.cl_args.download and (self.disk.timestamp < self.picasa.timestamp or self.album.cl_args.force_update):
                 self.download(reason = u' {0}because it is newer than the one in the album "{1.title}"'.format('[FORCED] ' if self.album.cl_args.force_update else '', self.album))
-                self.download_thumbnail(reason = ' thumbnail')
+                if not self.hasCurrentThumbnail():
+                    self.download_thumbnail(reason = ' thumbnail')
 
 class Album(dict):
     LOG = logging.getLogger('Album')
 
     def __init__(self, cl_args, title = None, disk = None, picasa = None):
         self.client = None
+        self.scheduler = None
+        self.transformer = None
+        self.thumbnails = None
+        self.prefetcher = None
+        self.batch = None
+        self.journal = None
+        self.planned = None
+        self.state = None
+        self.group = None
+        self.started = None
+        self.failed = False
+        self.unread = False
+        self.unchanged = None
+        self.fingerprint = None
         self.cl_args = cl_args
         self.disk = disk
         self.picasa = picasa
@@ -348,21 +413,56 @@ class Album(dict):
         self.filled_from_disk = False
         self.filled_from_picasa = False
 
+    @apply
+    def client():
+        def fget(self):
+            if self.scheduler:
+                return self.scheduler.client
+            return self._client
+        def fset(self, client):
+            self._client = client
+        return property(**locals())
+
+    def error(self, e):
+        self.failed = True
+        metrics.error(e)
+
+    def record(self, action, path = None, target = None):
+        if self.journal:
+            return self.journal.record_action(action, self.title, path, target)
+        return None
+
+    def finish(self, planned, target = None):
+        if planned:
+            self.journal.finish_action(planned, target)
+
+    def dispatch(self, func, *args, **kwargs):
+        if self.scheduler:
+            self.scheduler.submit(self.group, func, *args, **kwargs)
+        else:
+            func(*args, **kwargs)
+
     def combine(self, other):
         if self.isInDisk() and not other.isInDisk() and other.isInPicasa():
             self.picasa = other.picasa
+            # Left with a duplicate of its title when it was listed
+            self.failed = self.failed or other.failed
         elif self.isInPicasa() and not other.isInPicasa() and other.isInDisk():
             self.disk = other.disk
+            # The remote album was listed first, it takes over the photos
+            for photo in other.itervalues():
+                photo.album = self
+            self.update(other)
+            self.filled_from_disk = other.filled_from_disk
         else:
             raise InvalidArguments(u'Tried to combine the album "{0}" with another of the same type'.format(self.title))
 
-    def fillFromDisk(self, files):
+    def fillFromDisk(self, entries):
         if self.filled_from_disk:
             return
 
-        for f in files:
-            raw = mimetypes.guess_type(f)[0] in AlbumList.raw_types
-            photo = Photo(self, disk = PhotoDiskEntry(self.cl_args, f, self.disk.path), raw = raw)
+        for entry in entries:
+            photo = Photo(self, disk = entry, raw = entry.mimetype in AlbumList.raw_types)
             if photo.title in self:
                 self[photo.title].combine(photo)
             else:
@@ -371,12 +471,29 @@ class Album(dict):
 
     def fillFromPicasa(self):
         if self.filled_from_picasa:
-            return
+            return True
+
+        try:
+            with metrics.phase('feed'):
+                remotes = self.prefetcher and self.prefetcher.take(self.title)
+                self.readPicasa(self.feed(self.client) if remotes is None else remotes)
+        except API_ERRORS as e:
+            # An album that could not be read must not look empty
+            self.LOG.error(u'Error reading album "{0}": '.format(self.title) + str(e))
+            self.error(e)
+            self.unread = True
+            return False
+        self.filled_from_picasa = True
+        return True
+
+    def feed(self, client):
+        return FeedReader(client).read('/data/feed/api/user/default/albumid/%s?kind=photo&imgmax=1600' % self.picasa.gphoto_id.text, RemotePhoto.from_element)
 
-        for i, photo_entry in enumerate(self.client.GetEntries('/data/feed/api/user/default/albumid/%s?kind=photo&imgmax=1600' % self.picasa.gphoto_id.text)):
-            if mimetypes.guess_type(photo_entry.title.text)[0] in AlbumList.standard_types.union(AlbumList.raw_types):
-                photo_entry.title = atom.Title(text = os.path.splitext(photo_entry.title.text)[0])
-            photo = Photo(self, picasa = photo_entry)
+    def readPicasa(self, remotes):
+        for i, remote in enumerate(remotes):
+            if mimetypes.guess_type(remote.title)[0] in AlbumList.standard_types.union(AlbumList.raw_types):
+                remote.title = os.path.splitext(remote.title)[0]
+            photo = Photo(self, picasa = remote)
             photo.order_id = i
             if photo.title in self:
                 try:
@@ -387,7 +504,6 @@ class Album(dict):
                     self.LOG.error(e)
             else:
                 self[photo.title] = photo
-        self.filled_from_picasa = True
 
     def isInDisk(self):
         return bool(self.disk) and bool(self.disk.timestamp)
@@ -395,17 +511,63 @@ class Album(dict):
     def isInPicasa(self):
         return bool(self.picasa)
 
+    def needsFeed(self):
+        # Whether sync reads the photos in Picasa
+        if self.isInPicasa() and self.isInDisk():
+            return not self.isUnchanged()
+        return self.isInPicasa() and self.cl_args.download
+
+    def syncMode(self):
+        return u','.join(flag for flag in ('upload', 'download', 'update', 'delete_photos') if getattr(self.cl_args, flag))
+
+    def remoteFingerprint(self):
+        return (self.picasa.gphoto_id.text, self.picasa.updated.text, int(self.picasa.numphotos.text))
+
+    def localFingerprint(self):
+        # Adding, removing or renaming a file changes the list of names,
+        # editing one in place its mtime. Not the directory mtime, which
+        # the index changes whenever it is kept in the album.
+        files = sorted((photo.title, photo.disk.mtime) for photo in self.itervalues() if photo.isInDisk())
+        return (hashlib.sha1(repr(files)).hexdigest(), len(files), max([mtime for title, mtime in files] or [0]))
+
+    def lastSynced(self):
+        if not self.cl_args.skip_unchanged or not self.state or self.cl_args.force_update:
+            return None
+        return self.state.lookup_album(self.title)
+
+    def isRemoteUnchanged(self):
+        last = self.lastSynced()
+        return bool(last) and last[:3] == self.remoteFingerprint()
+
+    def isUnchanged(self):
+        # Neither side changed since the album was last synced without
+        # errors in the same mode. Both fingerprints are taken before the
+        # sync, so whatever it changes gets the album checked once more.
+        if self.unchanged is None:
+            self.unchanged = False
+            if self.cl_args.skip_unchanged and self.state and not self.cl_args.force_update:
+                self.fingerprint = self.localFingerprint()
+                self.unchanged = self.lastSynced() == self.remoteFingerprint() + (self.syncMode(),) + self.fingerprint
+        return self.unchanged
+
+    def recordSynced(self):
+        if self.fingerprint and not self.unchanged and not self.failed and not self.cl_args.dry_run:
+            self.state.store_album(self.title, *(self.remoteFingerprint() + (self.syncMode(),) + self.fingerprint))
+
     @dryrun('self.cl_args.dry_run', LOG, u'Creating album "{self.title}"{reason}')
     def upload(self):
         access = googlecl.picasa._map_access_string(self.client.config.lazy_get(picasa.SECTION_HEADER, 'access'))
+        planned = self.record('create', self.disk.path)
         try:
             self.picasa = self.client.InsertAlbum(title = self.title, summary = None, access = access, timestamp = str(long(self.disk.timestamp) * 1000))
-        except GooglePhotosException as e:
+        except API_ERRORS as e:
             self.LOG.error(u'Error creating album "{0}": '.format(self.title) + str(e))
+            self.error(e)
         else:
+            self.finish(planned, self.picasa.gphoto_id.text)
             for photo_title in sorted(self.iterkeys()):
                 photo = self[photo_title]
-                photo.upload()
+                self.dispatch(photo.upload)
 
     @dryrun('self.cl_args.dry_run', LOG, u'Creating directory "{self.title}"{reason}')
     def download(self, root):
@@ -418,6 +580,7 @@ class Album(dict):
             os.utime(self.disk.path, (timestamp, timestamp))
         except EnvironmentError as e:
             self.LOG.error(u'Cannot create local directory: ' + str(e))
+            self.error(e)
         else:
             self.disk.timestamp = timestamp
 
@@ -428,16 +591,18 @@ class Album(dict):
             os.utime(self.disk_thubmnail.path, (timestamp, timestamp))
         except EnvironmentError as e:
             self.LOG.error(u'Cannot create local directory: ' + str(e))
+            self.error(e)
         else:
             self.disk_thubmnail.timestamp = timestamp
 
         ff = os.path.join(self.disk_thubmnail.path, '__album.jpg')
-        urllib.urlretrieve(self.picasa.media.thumbnail[0].url, ff)
+        self.thumbnails.submit(self.picasa.media.thumbnail[0].url, ff, timestamp, self)
 
-        self.fillFromPicasa()
+        if not self.fillFromPicasa():
+            return
         for photo_title in sorted(self.iterkeys()):
             photo = self[photo_title]
-            photo.sync()
+            self.dispatch(photo.sync)
             #photo.download()
 
     @dryrun('self.cl_args.dry_run', LOG, u'Deleting directory "{self.disk.path}"{reason}')
@@ -450,15 +615,17 @@ class Album(dict):
             os.rmdir(self.disk.path)
         except EnvironmentError as e:
             self.LOG.error('Cannot delete local directory: ' + str(e))
+            self.error(e)
         finally:
             self.disk = None
 
-    @dryrun('self.cl_args.dry_run', LOG, u'Deleting album "{self.title}"{reason}')
+    @dryrun('self.cl_args.dry_run', LOG, u'Deleting album "{self.title}"{reason}', phase = 'delete')
     def deleteFromPicasa(self):
         try:
             self.client.Delete(self.picasa)
-        except GooglePhotosException as e:
+        except API_ERRORS as e:
             self.LOG.error(u'Error deleting album "{0}": '.format(self.title) + str(e))
+            self.error(e)
         finally:
             self.picasa = None
 
@@ -478,63 +645,84 @@ class Album(dict):
             if self.cl_args.download:
                 self.download(root, reason = u' because it does not exist locally')
         else:
+            if self.isUnchanged():
+                self.LOG.debug(u'Skipping album "{0}" because it did not change since the last sync'.format(self.title))
+                metrics.count('albums_skipped')
+                return
             self.LOG.debug(u'Checking album "{0}"...'.format(self.title))
-            self.fillFromPicasa()
+            if not self.fillFromPicasa():
+                return
             for photo_title in sorted(self.iterkeys()):
                 photo = self[photo_title]
-                photo.sync()
+                self.dispatch(photo.sync)
 
 class AlbumList(dict):
     LOG = logging.getLogger('AlbumList')
     standard_types = set(['image/jpeg', 'image/x-ms-bmp', 'image/gif', 'image/png'])
     raw_types = set(['image/x-nikon-nef'])
+    QUEUE_DEPTH = 16
+    EXPORT_FILENAME = 'data.json'
 
-    def __init__(self, clients, cl_args):
+    def __init__(self, clients, cl_args, state = None, transformer = None):
         self.clients = clients
         self.cl_args = cl_args
+        self.state = state
+        self.transformer = transformer
+        # Kept in the index. Nothing is done in a dry run that could be
+        # resumed.
+        self.journal = state if not cl_args.dry_run else None
+        self.lock = threading.Lock()
         self.supported_types = self.standard_types
         if self.cl_args.transform and 'raw' in self.cl_args.transform:
             self.supported_types = self.supported_types.union(self.raw_types)
         self.filled_from_disk = False
         self.filled_from_picasa = False
+        self.prefetcher = None
+        self.exporter = None
+
+    def diskScanner(self):
+        scanner = DiskScanner(self.supported_types, self.cl_args.threads)
+        return scanner, lambda root, name, st: PhotoDiskEntry(self.cl_args, name, root, self.state, st, scanner.mimetype(name))
 
     def fillFromDisk(self):
         if self.filled_from_disk:
             return
 
+        scanner, resolve = self.diskScanner()
         for path in self.cl_args.paths:
-            for root, dirs, files in os.walk(path):
-                supported_files = sorted([f for f in files if mimetypes.guess_type(f)[0] in self.supported_types])
-                if len(supported_files) == 0:
-                    continue
-                if root == path:
-                    album_title = os.path.basename(os.path.normpath(root))
-                elif len(self.cl_args.paths) > 1 or googlecl.safe_decode(os.path.basename(os.path.normpath(path))) in self:
-                    album_title = os.path.join(os.path.basename(os.path.normpath(path)), os.path.relpath(root, path))
-                else:
-                    album_title = os.path.relpath(root, path)
-                num_albums = (len(supported_files) + self.cl_args.max_photos - 1) / self.cl_args.max_photos
-                full_album_title = album_title
-                for i in xrange(0, num_albums):
-                    if num_albums > 1:
-                        self.LOG.debug(u'Splicing album "{0} ({1})" with photos from "{2}" to "{3}"'.format(album_title, i + 1, supported_files[i * self.cl_args.max_photos], supported_files[min(i * self.cl_args.max_photos + self.cl_args.max_photos - 1, len(supported_files) - 1)]))
-                        full_album_title = album_title + ' (%s)' % (i + 1)
-                    album = Album(self.cl_args, full_album_title, disk = AlbumDiskEntry(self.cl_args, root))
-                    album.fillFromDisk(supported_files[i * self.cl_args.max_photos:i * self.cl_args.max_photos + self.cl_args.max_photos])
-                    if album.title in self:
-                        self[album.title].combine(album)
-                    else:
-                        self[album.title] = album
+            directories = scanner.scan(path, resolve)
+            # Sorted, the top directory comes before its subdirectories as
+            # with os.walk
+            for root in sorted(directories):
+                for album in self.diskAlbums(path, root, directories[root], path in directories):
+                    _add_album(self, album)
         self.filled_from_disk = True
 
-    def fillFromPicasa(self):
-        if self.filled_from_picasa:
+    def diskAlbums(self, path, root, files, path_is_album):
+        entries = [entry for name, entry in filter(None, files)]
+        if len(entries) == 0:
             return
-
-        for album_entry in self.clients[0].GetEntries('/data/feed/api/user/default?kind=album'):
-            print "HERE"
-            print album_entry
-            self.LOG.error("Rights: %s", album_entry.rights.text)
+        if root == path:
+            album_title = os.path.basename(os.path.normpath(root))
+        elif len(self.cl_args.paths) > 1 or path_is_album:
+            album_title = os.path.join(os.path.basename(os.path.normpath(path)), os.path.relpath(root, path))
+        else:
+            album_title = os.path.relpath(root, path)
+        num_albums = (len(entries) + self.cl_args.max_photos - 1) / self.cl_args.max_photos
+        full_album_title = album_title
+        for i in xrange(0, num_albums):
+            if num_albums > 1:
+                self.LOG.debug(u'Splicing album "{0} ({1})" with photos from "{2}" to "{3}"'.format(album_title, i + 1, entries[i * self.cl_args.max_photos].path, entries[min(i * self.cl_args.max_photos + self.cl_args.max_photos - 1, len(entries) - 1)].path))
+                full_album_title = album_title + ' (%s)' % (i + 1)
+            album = Album(self.cl_args, full_album_title, disk = AlbumDiskEntry(self.cl_args, root))
+            album.fillFromDisk(entries[i * self.cl_args.max_photos:i * self.cl_args.max_photos + self.cl_args.max_photos])
+            yield album
+
+    def picasaAlbums(self):
+        with metrics.phase('feed'):
+            entries = list(FeedReader(self.clients[0]).read('/data/feed/api/user/default?kind=album', album_from_element))
+        for album_entry in entries:
+            self.LOG.debug(u'Remote album "{0}" is {1}'.format(album_entry.title.text, album_entry.rights.text))
             if album_entry.rights.text != 'public':
                 continue
             is_buzz = False
@@ -543,17 +731,99 @@ class AlbumList(dict):
                     is_buzz = True
             if is_buzz:
                 continue
-            album = Album(self.cl_args, picasa = album_entry)
-            if album.title in self:
-                self[album.title].combine(album)
+            yield Album(self.cl_args, picasa = album_entry)
+
+    def picasaAlbum(self, album_id):
+        try:
+            with metrics.phase('feed'):
+                return self.clients[0].GetEntry('/data/entry/api/user/default/albumid/%s' % album_id)
+        except GooglePhotosException as e:
+            if e.error_code == 404:
+                # Deleted since
+                return None
+            raise
+
+    def fillFromPicasa(self):
+        if self.filled_from_picasa:
+            return
+
+        for album in self.picasaAlbums():
+            _add_album(self, album)
+        self.filled_from_picasa = True
+
+    def lastRun(self):
+        # The journal rows of the interrupted sync to resume, or None when
+        # everything has to be synced
+        if not self.journal:
+            self.LOG.warn(u'Cannot resume without the index, syncing everything')
+            return None
+        rows, planned = self.journal.last_run()
+        if rows is None:
+            self.LOG.info(u'No interrupted sync to resume')
+            return []
+        if not planned:
+            self.LOG.warn(u'The interrupted sync had not planned all its albums yet, syncing everything')
+            return None
+        return rows
+
+    def fillFromJournal(self, rows):
+        # Only the albums the interrupted sync did not finish, each from a
+        # listing of its own directory and its own Picasa entry. Whatever of
+        # them was done before is found done again when they are synced.
+        albums = collections.OrderedDict()
+        unfinished = 0
+        for action, title, path, target, done in rows:
+            if action == 'album':
+                if not done:
+                    albums[title] = [path, target]
+            elif action == 'create':
+                if done and title in albums:
+                    albums[title][1] = target
+            elif not done:
+                # A download left its .part file. It resumes from it only
+                # if the photo is still the version the data came from.
+                unfinished += 1
+        if rows:
+            self.LOG.info(u'Resuming {0} albums with {1} unfinished actions'.format(len(albums), unfinished))
+
+        scanner, resolve = self.diskScanner()
+        with metrics.phase('scan'):
+            for title, (root, album_id) in albums.iteritems():
+                root = root or os.path.join(self.cl_args.paths[0], title)
+                path = next((path for path in self.cl_args.paths if not os.path.relpath(root, path).startswith(os.pardir)), None)
+                if path is None or not os.path.isdir(root):
+                    continue
+                files = [(name, resolve(root, name, st)) for name, st in sorted(scanner.listdir(root)[0])]
+                path_is_album = root == path or bool(scanner.listdir(path)[0])
+                for album in self.diskAlbums(path, root, files, path_is_album):
+                    if album.title in albums:
+                        _add_album(self, album)
+        self.filled_from_disk = True
+
+        missing = []
+        for title, (root, album_id) in albums.iteritems():
+            if album_id:
+                entry = self.picasaAlbum(album_id)
+                if entry:
+                    _add_album(self, Album(self.cl_args, picasa = entry))
             else:
-                self[album.title] = album
+                missing.append(title)
+        if missing:
+            # Whether they were created before the sync was interrupted only
+            # the album list tells
+            for album in self.picasaAlbums():
+                if album.title in missing:
+                    _add_album(self, album)
         self.filled_from_picasa = True
 
-    def add_item_to_dict(self, title, album):
-        if not album.picasa:
+    def export(self, title, album):
+        if not self.exporter or not album.picasa:
             # Skip if there is no online entry.
             return
+        if album.unchanged or album.unread:
+            # Its photos were not read from Picasa this time
+            self.exporter.keep(title)
+            return
         album_dict = dict()
         album_dict['title'] = title
         album_dict['published'] = album.picasa.published.text
@@ -562,44 +832,200 @@ class AlbumList(dict):
         for photo_name in sorted(album.keys(), key=lambda x: album[x].order_id):
             photo = album[photo_name]
             photo_dict = {'name': photo_name}
-            if photo.picasa and photo.picasa.summary.text:
-                photo_dict['summary'] = googlecl.safe_decode(photo.picasa.summary.text)
+            if photo.picasa and photo.picasa.summary:
+                photo_dict['summary'] = googlecl.safe_decode(photo.picasa.summary)
             album_dict['photos'].append(photo_dict)
-        self.dict_for_dump[title] = album_dict
-        self.LOG.error("%s: %s", title, album)
+        self.exporter.write(title, album_dict)
+        self.LOG.debug("%s: %s", title, album)
+
+    def attach(self, album):
+        album.state = self.state
+        album.transformer = self.transformer
+        album.thumbnails = self.thumbnails
+        album.prefetcher = self.prefetcher
+        album.journal = self.journal
+        if not album.batch and self.cl_args.force_update == 'metadata' and self.cl_args.batch_size > 1:
+            album.batch = MetadataBatch(album, self.cl_args.batch_size)
+
+    def plan(self, album):
+        if self.journal:
+            album.planned = self.journal.record_action('album', album.title, album.disk and album.disk.path, album.picasa and album.picasa.gphoto_id.text)
+
+    def planAlbums(self):
+        # All of them before any starts, so a killed run leaves every album
+        # it did not finish in the journal
+        if not self.journal:
+            return
+        plan = self.journal.begin_plan()
+        for album_title in sorted(self.iterkeys()):
+            self.plan(self[album_title])
+        self.journal.end_plan(plan)
+
+    def prefetch(self, album):
+        if self.prefetcher and album.needsFeed():
+            self.prefetcher.submit(album)
+
+    def album_done(self, album_title):
+        if self.prefetcher:
+            self.prefetcher.discard(album_title)
+        album = self[album_title]
+        if album.group and album.group.failed:
+            album.failed = True
+        if album.batch:
+            # The album can finish on the main thread, which has no client
+            album.batch.flush(album.client or self.clients[0])
+        if not album.failed:
+            album.finish(album.planned)
+        album.recordSynced()
+        with self.lock:
+            metrics.album(album_title, time.time() - self[album_title].started)
+            self.export(album_title, self[album_title])
+            del self[album_title]
+
+    def start(self, scheduler, album_title):
+        album = self[album_title]
+        album.scheduler = scheduler
+        album.started = time.time()
+        self.attach(album)
+        self.prefetch(album)
+        album.group = TaskGroup(functools.partial(self.album_done, album_title))
+        album.dispatch(album.sync)
+        album.group.close()
+
+    def syncPipelined(self):
+        # Albums are handed to the workers as soon as their directory is
+        # scanned, while the rest of the tree is still being scanned. The
+        # remote album list is read meanwhile and has to be complete before
+        # the first album starts, or it could be created again.
+        remote = dict()
+        errors = []
+        def fetch():
+            try:
+                for album in self.picasaAlbums():
+                    _add_album(remote, album)
+            except Exception:
+                errors.append(sys.exc_info())
+        fetcher = threading.Thread(target = fetch)
+        fetcher.daemon = True
+        fetcher.start()
+
+        directories = Queue.Queue()
+        scan_errors = []
+        def scan():
+            scanner, resolve = self.diskScanner()
+            try:
+                for path in self.cl_args.paths:
+                    scanner.scan(path, resolve, lambda root, files: directories.put((path, root, files, path in scanner.directories)))
+            except Exception:
+                scan_errors.append(sys.exc_info())
+            finally:
+                directories.put(None)
+        walker = threading.Thread(target = scan)
+        walker.daemon = True
+        walker.start()
+
+        fetcher.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        self.filled_from_picasa = True
+        # Until the scan is done the journal cannot tell every album that
+        # is left, an interrupted run is synced again whole
+        plan = self.journal and self.journal.begin_plan()
+
+        scheduler = Scheduler(self.clients, self.cl_args.threads * self.QUEUE_DEPTH)
+        started = set()
+        for directory in iter(directories.get, None):
+            for album in self.diskAlbums(*directory):
+                if album.title in started:
+                    self.LOG.error(u'Tried to combine the album "{0}" with another of the same type'.format(album.title))
+                    continue
+                if album.title in remote:
+                    album.combine(remote.pop(album.title))
+                started.add(album.title)
+                with self.lock:
+                    self[album.title] = album
+                self.plan(album)
+                self.start(scheduler, album.title)
+        walker.join()
+        if scan_errors:
+            # The local tree is incomplete, the albums left in remote may
+            # well exist on disk and must be neither downloaded nor deleted
+            scheduler.join()
+            raise scan_errors[0][0], scan_errors[0][1], scan_errors[0][2]
+        self.filled_from_disk = True
 
-    def sync(self):
-        self.fillFromDisk()
-        self.fillFromPicasa()
+        for album_title in sorted(remote):
+            with self.lock:
+                self[album_title] = remote[album_title]
+            self.plan(remote[album_title])
+            self.start(scheduler, album_title)
+        if plan:
+            self.journal.end_plan(plan)
+        scheduler.join()
 
-        self.dict_for_dump = dict()
-        if self.cl_args.threads == 1:
+    def sync(self):
+        resume = self.lastRun() if self.cl_args.resume else None
+        if self.cl_args.prefetch:
+            self.prefetcher = FeedPrefetcher(self.clients, self.cl_args.prefetch)
+        if not self.cl_args.no_export:
+            self.exporter = Exporter(self.EXPORT_FILENAME)
+            # When resuming, the albums that were finished keep their records
+            self.exporter.keep_rest = resume is not None
+        try:
+            self.syncAlbums(resume)
+            if self.exporter:
+                self.exporter.close()
+                self.exporter = None
+            if self.journal:
+                self.journal.prune_journal()
+        finally:
+            if self.exporter:
+                self.exporter.abort()
+            if self.prefetcher:
+                self.prefetcher.close()
+
+    def syncAlbums(self, resume = None):
+        self.thumbnails = ThumbnailFetcher(self.cl_args.threads, self.state, self.cl_args.threads * self.QUEUE_DEPTH)
+        if resume is not None:
+            self.fillFromJournal(resume)
+        elif not self.cl_args.pipeline:
+            self.fillFromPicasa()
+            if self.prefetcher:
+                # Read ahead while the disk is scanned, in sync order. Until
+                # then it is not known which albums exist only in Picasa, so
+                # a few of those may be read for nothing in an upload.
+                for album_title in sorted(self.iterkeys()):
+                    album = self[album_title]
+                    self.attach(album)
+                    if not album.isRemoteUnchanged():
+                        self.prefetcher.submit(album)
+            self.fillFromDisk()
+            if self.prefetcher:
+                for album_title, album in self.iteritems():
+                    self.attach(album)
+                    if not album.needsFeed():
+                        self.prefetcher.discard(album_title)
+
+        if self.cl_args.pipeline and resume is None:
+            self.syncPipelined()
+        elif self.cl_args.threads == 1:
+            self.planAlbums()
             for album_title in sorted(self.iterkeys()):
                 album = self[album_title]
                 album.client = self.clients[0]
+                album.started = time.time()
+                self.attach(album)
+                # Finished once its thumbnails are
+                album.group = TaskGroup(functools.partial(self.album_done, album_title))
                 album.sync()
-                self.add_item_to_dict(album_title, self[album_title])
-                del self[album_title]
+                album.group.close()
         else:
-            threads = []
-            clients = self.clients[:]
+            self.planAlbums()
+            scheduler = Scheduler(self.clients, self.cl_args.threads * self.QUEUE_DEPTH)
             for album_title in sorted(self.iterkeys()):
-                album = self[album_title]
-                if len(threads) == self.cl_args.threads:
-                    for i in itertools.cycle(xrange(len(threads))):
-                        threads[i][0].join(0.1)
-                        if not threads[i][0].is_alive():
-                            clients.append(threads[i][1].client)
-                            self.add_item_to_dict(album_title, self[album_title])
-                            del self[album_title]
-                            del threads[i]
-                            break
-                album.client = clients.pop()
-                new_thread = threading.Thread(target = album.sync)
-                new_thread.start()
-                threads.append((new_thread, album))
-            for (thread, album) in threads:
-                thread.join()
+                self.start(scheduler, album_title)
+            scheduler.join()
+        self.thumbnails.join()
 
         #for title, album in self.items():
             #album_dict = dict()
@@ -613,10 +1039,6 @@ class AlbumList(dict):
             #dict_for_dump[title] = album_dict
             #self.LOG.error("%s: %s", title, album)
 
-        self.LOG.error("%s", self.dict_for_dump)
-        import json
-        json.dump(self.dict_for_dump, open('data.json', 'w'))
-
 
 class ListParser:
     def __init__(self, unique = True, type = str, nargs = None, separator = ',', choices = None):
@@ -661,6 +1083,12 @@ class StreamLogger(object):
 class PicasaSync(object):
     MAX_PHOTOS_PER_ALBUM = 1000
     MAX_PHOTO_SIZE = [2048, 2048]
+    INDEX_FILENAME = '.picasasync.db'
+    INDEX_DIR = os.path.join('~', '.picasasync')
+    CACHE_SIZE = 1024
+    RETRIES = 5
+    PREFETCH_ALBUMS = 4
+    BATCH_SIZE = 100
     LOG = logging.getLogger('PicasaSync')
 
     def __init__(self):
@@ -675,6 +1103,7 @@ class PicasaSync(object):
         self.clients = []
         for i in xrange(self.cl_args.threads):
             client = picasa_service.SERVICE_CLASS(config)
+            client.http_client = transfer.PooledHttpClient()
             client.debug = self.cl_args.debug
             client.email = config.lazy_get(picasa.SECTION_HEADER, 'user')
             auth_manager = googlecl.authentication.AuthenticationManager('picasa', client)
@@ -683,8 +1112,68 @@ class PicasaSync(object):
                 self.LOG.error('Error using OAuth token. You have to authenticate with googlecl using "google picasa list-albums --force-auth" and following the instructions')
             self.clients.append(client)
 
+    def default_index(self):
+        # Kept out of the synced tree, which may be on a network filesystem
+        # where the WAL journal is not safe, and named after the library
+        library = os.path.abspath(self.cl_args.paths[0])
+        directory = os.path.expanduser(self.INDEX_DIR)
+        path = os.path.join(directory, hashlib.sha1(library).hexdigest() + '.db')
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        # Indexes of earlier versions were in the first PATH
+        old = os.path.join(library, self.INDEX_FILENAME)
+        if os.path.exists(old) and not os.path.exists(path):
+            self.LOG.info(u'Moving index "{0}" to "{1}"'.format(old, path))
+            for suffix in ('-wal', '-shm', ''):
+                if os.path.exists(old + suffix):
+                    shutil.move(old + suffix, path + suffix)
+        return path
+
+    def open_state(self):
+        if self.cl_args.no_index:
+            return None
+        try:
+            path = self.cl_args.index or self.default_index()
+            state = StateStore(path)
+        except EnvironmentError as e:
+            self.LOG.error(u'Cannot create index: ' + str(e))
+            return None
+        except sqlite3.Error as e:
+            self.LOG.error(u'Cannot open index "{0}": '.format(path) + str(e))
+            return None
+        if self.cl_args.rebuild_index:
+            state.rebuild()
+        return state
+
     def sync(self):
-        AlbumList(self.clients, self.cl_args).sync()
+        # The feeds read ahead get requests of their own on top of the workers'
+        throttle = Throttle(self.cl_args.threads + (FeedPrefetcher.THREADS if self.cl_args.prefetch else 0), self.cl_args.retries)
+        for client in self.clients:
+            throttle.wrap(client)
+        state = self.open_state()
+        transformer = None
+        if self.cl_args.transform or self.cl_args.strip_exif:
+            transformer = Transformer(self.cl_args, AlbumList.standard_types, self.ncores)
+        try:
+            AlbumList(self.clients, self.cl_args, state, transformer).sync()
+        finally:
+            self.LOG.info('HTTP connections: {created} opened, {reused} reused'.format(**transfer.pool.stats()))
+            if transformer:
+                transformer.close()
+            if state:
+                if self.cl_args.compact_index:
+                    state.compact()
+                state.close()
+            self.write_metrics()
+
+    def write_metrics(self):
+        for path, write in ((self.cl_args.metrics_json, metrics.write_json), (self.cl_args.metrics_prom, metrics.write_prometheus)):
+            if not path:
+                continue
+            try:
+                write(path)
+            except EnvironmentError as e:
+                self.LOG.error(u'Cannot write metrics to "{0}": '.format(path) + str(e))
 
     def parse_cl_args(self):
         parser = argparse.ArgumentParser(description = 'Sync one or more directories with your Picasa Web account. If only one directory is given and it doesn\'t contain any supported file, it is assumed to be the parent of all the local albums.')
@@ -695,14 +1184,33 @@ class PicasaSync(object):
         parser.add_argument('-u', '--upload', dest = 'upload', action = 'store_true', help = 'Upload missing remote photos')
         parser.add_argument('-d', '--download', dest = 'download', action = 'store_true', help = 'Download missing local photos')
         parser.add_argument('-r', '--update', dest = 'update', action = 'store_true', help = 'Update changed local or remote photos')
-        parser.add_argument('-t', '--threads', dest = 'threads', type = int, nargs = '?', const = self.ncores, default = 1, help = 'Multithreaded operation. Set number of threads to use on album processing. If not given defaults to 1, if given without argument, defaults to number of CPU cores (%s in this system).' % self.ncores)
+        parser.add_argument('-t', '--threads', dest = 'threads', type = int, nargs = '?', const = self.ncores, default = 1, help = 'Multithreaded operation. Set number of threads to use on directory scanning and album and photo processing. If not given defaults to 1, if given without argument, defaults to number of CPU cores (%s in this system).' % self.ncores)
         parser.add_argument('-o', '--origin', dest = 'origin', metavar = 'ORIGINS', type = ListParser(choices = ('filename', 'exif', 'stat')), default = ['exif', 'stat'], help = 'Timestamp origin. ORIGINS is a comma separated list of values "filename", "exif" or "stat" which will be probed in order. Default is "exif,stat".')
+        parser.add_argument('--pipeline', dest = 'pipeline', action = 'store_true', help = 'Start syncing each album as soon as its directory is scanned, instead of waiting for the whole local tree')
+        parser.add_argument('--download-segments', dest = 'download_segments', metavar = 'NUMBER', type = int, default = 1, help = 'Download large photos as NUMBER parallel ranges. Default is 1.')
+        parser.add_argument('--prefetch', dest = 'prefetch', metavar = 'NUMBER', type = int, default = self.PREFETCH_ALBUMS, help = 'Read the photo lists of up to NUMBER albums from Picasa ahead of the albums being synced, 0 to read each one when its album is synced. Default is %s.' % self.PREFETCH_ALBUMS)
+        parser.add_argument('--batch-size', dest = 'batch_size', metavar = 'NUMBER', type = int, default = self.BATCH_SIZE, help = 'Send the updates of --force-update=metadata in batches of up to NUMBER photos per request, 0 or 1 to update each photo on its own. Default is %s.' % self.BATCH_SIZE)
+        parser.add_argument('--retries', dest = 'retries', metavar = 'NUMBER', type = int, default = self.RETRIES, help = 'Retry API requests throttled by the server up to NUMBER times, waiting longer each time, and send fewer requests at once meanwhile. Default is %s.' % self.RETRIES)
+        parser.add_argument('--index', dest = 'index', metavar = 'FILE', help = 'Local scan index used to cache photo timestamps between runs. Default is a file named after the first PATH in "%s".' % self.INDEX_DIR)
+        parser.add_argument('--no-index', dest = 'no_index', action = 'store_true', help = 'Do not use the local scan index')
+        parser.add_argument('--rebuild-index', dest = 'rebuild_index', action = 'store_true', help = 'Discard the local scan index and rebuild it from scratch')
+        parser.add_argument('--compact-index', dest = 'compact_index', action = 'store_true', help = 'Remove entries of deleted files from the local scan index after syncing')
+        parser.add_argument('--skip-unchanged', dest = 'skip_unchanged', action = 'store_true', help = 'Skip the albums in which nothing changed locally or in Picasa since they were last synced, without reading their photos from Picasa. Changes that keep the file modification times are missed. Needs the index.')
+        parser.add_argument('--resume', dest = 'resume', action = 'store_true', help = 'Only finish the albums an interrupted sync left unfinished, reading each one from its own directory and Picasa entry instead of scanning and listing everything again. Needs the index.')
+        parser.add_argument('--content-hash', dest = 'content_hash', action = 'store_true', help = 'Only update photos whose contents changed, not just their timestamps. Content hashes are kept in the local scan index.')
+        parser.add_argument('--no-export', dest = 'no_export', action = 'store_true', help = 'Do not write the albums and photo summaries to %s' % AlbumList.EXPORT_FILENAME)
+        parser.add_argument('--metrics-json', dest = 'metrics_json', metavar = 'FILE', help = 'Write the time spent in each phase, bytes transferred, API calls and errors of the run to FILE as JSON')
+        parser.add_argument('--metrics-prom', dest = 'metrics_prom', metavar = 'FILE', help = 'Write the same metrics to FILE in the Prometheus text format, for the node exporter textfile collector')
         group = parser.add_argument_group('DANGEROUS', 'Dangerous options that should be used with care')
         group.add_argument('--max-size', dest = 'max_size', type = ListParser(unique = False, type = int, nargs = 2), default = self.MAX_PHOTO_SIZE, help = 'Maximum size of photo when using --transform=resize. Default is %s.' % self.MAX_PHOTO_SIZE)
         group.add_argument('--force-update', dest = 'force_update', choices = ('full', 'metadata'), nargs = '?', const = 'full', help = 'Force updating photos regardless of modified status (Assumes --update). If no argument given, it assumes full.')
         group.add_argument('--delete-photos', dest = 'delete_photos', action = 'store_true', help = 'Delete remote or local photos not present on the other album')
         group.add_argument('--strip-exif', dest = 'strip_exif', action = 'store_true', help = 'Strip EXIF data from your photos on upload.')
         group.add_argument('--transform', dest = 'transform', metavar = 'TRANSFORMS', type = ListParser(choices = ('raw', 'rotate', 'resize')), help = 'Transform the local files before uploading them. TRANSFORMS is a list of transformations to apply, from "raw", "rotate" and "resize".')
+        group.add_argument('--spool-dir', dest = 'spool_dir', metavar = 'DIR', help = 'Directory for the temporary files written by --transform and --strip-exif. Default is the system temporary directory.')
+        group.add_argument('--max-memory', dest = 'max_memory', metavar = 'MB', type = int, help = 'Maximum size in megabytes of the photos being transformed at the same time. Default is no limit.')
+        group.add_argument('--cache-dir', dest = 'cache_dir', metavar = 'DIR', help = 'Keep the photos produced by --transform and --strip-exif in DIR and reuse them while neither the photo nor the options change.')
+        group.add_argument('--cache-size', dest = 'cache_size', metavar = 'MB', type = int, default = self.CACHE_SIZE, help = 'Maximum size in megabytes of --cache-dir. The least recently used photos are evicted first. Default is %s.' % self.CACHE_SIZE)
         group = parser.add_argument_group('VERY DANGEROUS', 'Very dangerous options that should be used with extreme care')
         group.add_argument('--delete-albums', dest = 'delete_albums', action = 'store_true', help = 'Delete remote or local albums not present on the other system')
         parser.add_argument('paths', metavar = 'PATH', nargs = '+', help = 'Parent directory of the albums to sync')
@@ -736,6 +1244,18 @@ class PicasaSync(object):
             self.LOG.warn('You cannot force update when using bidirectional syncing. Disabling forced updates.')
             cl_args.force_update = False
 
+        if cl_args.content_hash and cl_args.no_index:
+            self.LOG.warn('Content hashes are kept in the local scan index. Disabling --content-hash.')
+            cl_args.content_hash = False
+
+        if cl_args.resume and (cl_args.no_index or cl_args.dry_run):
+            self.LOG.warn('The journal of interrupted syncs is kept in the local scan index and not written in a dry run. Disabling --resume.')
+            cl_args.resume = False
+
+        # Probed last when nothing else gives a timestamp
+        if 'stat' not in cl_args.origin:
+            cl_args.origin.append('stat')
+
         if cl_args.force_update and not cl_args.update:
             cl_args.update = True
 
@@ -0,0 +1,127 @@
+import threading, logging
+from xml.etree import cElementTree as ElementTree
+
+import atom
+import gdata
+import gdata.service
+import gdata.photos
+from gdata.photos.service import GooglePhotosException
+
+from feed import FeedReader
+from metrics import metrics
+
+class PhotoBatchEntry(gdata.photos.PhotoEntry):
+    # PhotoEntry does not know the batch elements, so they would be left out
+    # of the request and lost from the response
+    _children = gdata.photos.PhotoEntry._children.copy()
+    _children['{%s}operation' % gdata.BATCH_NAMESPACE] = ('batch_operation', gdata.BatchOperation)
+    _children['{%s}id' % gdata.BATCH_NAMESPACE] = ('batch_id', gdata.BatchId)
+    _children['{%s}status' % gdata.BATCH_NAMESPACE] = ('batch_status', gdata.BatchStatus)
+    batch_operation = None
+    batch_id = None
+    batch_status = None
+
+class PhotoBatchFeed(gdata.BatchFeed):
+    _children = gdata.BatchFeed._children.copy()
+    _children['{%s}entry' % atom.ATOM_NAMESPACE] = ('entry', [PhotoBatchEntry])
+
+def photo_batch_entry(element):
+    return atom.CreateClassFromXMLString(PhotoBatchEntry, ElementTree.tostring(element))
+
+def photo_batch_feed(xml_string):
+    return atom.CreateClassFromXMLString(PhotoBatchFeed, xml_string)
+
+class BatchError(Exception):
+    def __init__(self, code, reason):
+        Exception.__init__(self, code, reason)
+        self.code = code
+        self.reason = reason
+
+    def __str__(self):
+        return '{0} {1}'.format(self.code, self.reason)
+
+class MetadataBatch(object):
+    # Collects the metadata updates of the photos of an album and sends them
+    # as GData batch requests of up to size entries once the album is done.
+    # The entries to update are read again from the album feed, as only the
+    # compact records were kept. Every entry of the response is matched to
+    # its photo by batch id, so failures are still reported per photo.
+    LOG = logging.getLogger('MetadataBatch')
+
+    def __init__(self, album, size):
+        self.album = album
+        self.size = size
+        self.lock = threading.Lock()
+        self.photos = {}
+
+    def add(self, photo):
+        with self.lock:
+            self.photos[photo.picasa.id] = photo
+
+    def entry(self, element):
+        # Only the entries of the photos being updated are kept
+        photo_id = element.findtext('{http://schemas.google.com/photos/2007}id')
+        if photo_id not in self.photos:
+            return None
+        return photo_batch_entry(element)
+
+    def flush(self, client):
+        if not self.photos:
+            return
+        uri = '/data/feed/api/user/default/albumid/%s' % self.album.picasa.gphoto_id.text
+        try:
+            # Read whole before sending, the client cannot send a request
+            # while a feed page is still coming in
+            with metrics.phase('feed'):
+                entries = [entry for entry in FeedReader(client).read(uri + '?kind=photo', self.entry) if entry is not None]
+        except GooglePhotosException as e:
+            entries = []
+            error = e
+        else:
+            # Deleted from the album since it was read
+            error = BatchError(404, 'Not found')
+        for i in xrange(0, len(entries), self.size):
+            batch = PhotoBatchFeed()
+            for entry in entries[i:i + self.size]:
+                photo = self.photos[entry.gphoto_id.text]
+                entry.timestamp = gdata.photos.Timestamp(text = str(long(photo.disk.timestamp) * 1000))
+                batch.AddUpdate(entry, batch_id_string = entry.gphoto_id.text)
+            self.send(client, uri + '/batch', batch)
+        for photo in self.photos.values():
+            self.fail(photo, error)
+        self.photos.clear()
+
+    def fail(self, photo, e):
+        self.LOG.error(u'Error updating metadata for photo "{0}": '.format(photo.title) + str(e))
+        self.album.error(e)
+
+    def post(self, client, uri, batch):
+        try:
+            return client.Post(batch, uri, converter = photo_batch_feed)
+        except gdata.service.RequestError as e:
+            raise GooglePhotosException(e.args[0])
+
+    def send(self, client, uri, batch):
+        photos = dict((entry.batch_id.text, self.photos.pop(entry.batch_id.text)) for entry in batch.entry)
+        try:
+            with metrics.phase('batch'):
+                if getattr(client, 'throttle', None):
+                    response = client.throttle.call(self.post, client, uri, batch)
+                else:
+                    response = self.post(client, uri, batch)
+        except GooglePhotosException as e:
+            for photo in photos.itervalues():
+                self.fail(photo, e)
+            return
+        metrics.count('batch_requests')
+        for entry in response.entry:
+            photo = photos.pop(entry.batch_id.text if entry.batch_id else None, None)
+            if photo is None:
+                continue
+            status = entry.batch_status
+            if status is not None and status.code and int(status.code) >= 300:
+                self.fail(photo, BatchError(int(status.code), status.reason))
+            else:
+                photo.setRemote(entry)
+        for photo in photos.itervalues():
+            self.fail(photo, BatchError(500, 'No answer in the batch response'))
@@ -0,0 +1,151 @@
+import os, errno, hashlib, mimetypes, shutil, tempfile, threading, logging
+
+def content_hash(path, chunk_size = 1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+class DerivativeCache(object):
+    # Derivatives handed out by get or put are pinned until released, so
+    # eviction never removes one that is still being uploaded.
+    LOG = logging.getLogger('DerivativeCache')
+    SOURCE = '.source'
+    PARTIAL = '.part'
+    LOW_WATERMARK = 0.9
+
+    def __init__(self, directory, max_size):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.entries = {}
+        for f in os.listdir(self.directory):
+            if f.endswith(self.PARTIAL):
+                # Left by a put that was interrupted
+                os.remove(os.path.join(self.directory, f))
+            else:
+                self.entries[os.path.splitext(f)[0]] = f
+        self.sizes = dict((key, os.path.getsize(os.path.join(self.directory, f))) for key, f in self.entries.iteritems())
+        self.size = sum(self.sizes.itervalues())
+        self.pins = {}
+
+    def key(self, content, params):
+        return hashlib.sha1(content + repr(params)).hexdigest()
+
+    def pin(self, key):
+        # With self.lock held
+        self.pins[key] = self.pins.get(key, 0) + 1
+
+    def get(self, key):
+        # Returns the cached derivative and its mimetype, (None, None) if the
+        # source itself is to be uploaded, or None on a miss. A derivative
+        # stays pinned until it is released.
+        with self.lock:
+            if key not in self.entries:
+                return None
+            path = os.path.join(self.directory, self.entries[key])
+            try:
+                os.utime(path, None)
+            except EnvironmentError:
+                self.remove(key)
+                return None
+            if path.endswith(self.SOURCE):
+                return None, None
+            self.pin(key)
+        return path, mimetypes.guess_type(path)[0]
+
+    def put(self, key, path, mimetype):
+        if path is None:
+            name = key + self.SOURCE
+        else:
+            name = key + (mimetypes.guess_extension(mimetype) or '')
+        dest = os.path.join(self.directory, name)
+        if path is not None:
+            # Brought into the cache directory under a temporary name first,
+            # a copy from another filesystem is only renamed into place once
+            # it is complete
+            fd, tmp = tempfile.mkstemp(prefix = '.', suffix = self.PARTIAL, dir = self.directory)
+            os.close(fd)
+            try:
+                try:
+                    os.rename(path, tmp)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.copyfile(path, tmp)
+                    os.remove(path)
+            except:
+                os.remove(tmp)
+                raise
+        with self.lock:
+            existing = self.entries.get(key)
+            if existing is not None and (existing == name and os.path.exists(dest) or key in self.pins):
+                # Another worker made the same derivative meanwhile, the one
+                # in the cache may be in use and is kept
+                if path is None:
+                    return None
+                os.remove(tmp)
+                self.pin(key)
+                return os.path.join(self.directory, existing)
+            if existing is not None:
+                self.remove(key)
+            if path is None:
+                open(dest, 'w').close()
+            else:
+                os.rename(tmp, dest)
+                self.pin(key)
+            self.entries[key] = name
+            self.sizes[key] = os.path.getsize(dest)
+            self.size += self.sizes[key]
+            if self.size > self.max_size:
+                self.evict()
+        return dest if path else None
+
+    def release(self, path):
+        key = os.path.splitext(os.path.basename(path))[0]
+        with self.lock:
+            count = self.pins.pop(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            if self.size > self.max_size:
+                self.evict()
+
+    def contains(self, path):
+        return os.path.dirname(os.path.abspath(path)) == self.directory
+
+    def remove(self, key):
+        # With self.lock held
+        try:
+            os.remove(os.path.join(self.directory, self.entries[key]))
+        except EnvironmentError as e:
+            if os.path.exists(os.path.join(self.directory, self.entries[key])):
+                self.LOG.warn(u'Cannot evict "{0}": '.format(self.entries[key]) + str(e))
+                return False
+        del self.entries[key]
+        self.size -= self.sizes.pop(key, 0)
+        return True
+
+    def evict(self):
+        entries = []
+        for key, name in self.entries.iteritems():
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except EnvironmentError:
+                continue
+            self.sizes[key] = st.st_size
+            entries.append((st.st_mtime, key))
+        entries.sort()
+        self.size = sum(self.sizes[key] for mtime, key in entries)
+        # Keep the newest entry even if it alone is over the limit, and the
+        # ones still in use
+        for mtime, key in entries[:-1]:
+            if self.size <= self.max_size * self.LOW_WATERMARK:
+                break
+            if key not in self.pins:
+                self.remove(key)
@@ -1,72 +1,80 @@
 from collections import defaultdict
-from functools import wraps
-import string, inspect, logging
+from functools import partial
+import re, string, inspect, logging
+
+from metrics import metrics
 
 class dryrun(object):
 	class Formatter(string.Formatter):
 		def __init__(self, argspec):
-			self.argspec = argspec
+			self.defaults = {}
+			if argspec.defaults:
+				self.defaults = dict(zip(argspec.args[-len(argspec.defaults):], argspec.defaults))
+			self.args = argspec.args
+
+		def namespace(self, args, kwargs):
+			values = dict(self.defaults)
+			values.update(zip(self.args, args))
+			values.update(kwargs)
+			return values
 
 		def vformat(self, format_string, args, kwargs):
 			values = defaultdict(str)
-			if self.argspec.defaults:
-				values.update(dict(zip(self.argspec.args[-len(self.argspec.defaults):], self.argspec.defaults)))
-			values.update(dict(zip(self.argspec.args, args)))
-			values.update(kwargs)
-			formatted = super(dryrun.Formatter, self).vformat(format_string, args, values)
-			if not self.argspec.keywords:
-				for k in (k for k in self.used_args if k in kwargs and k not in self.argspec.args):
-					del kwargs[k]
-			return formatted
+			values.update(self.namespace(args, kwargs))
+			return super(dryrun.Formatter, self).vformat(format_string, args, values)
 
 		def check_unused_args(self, used_args, args, kwargs):
-			self.used_args = used_args
+			pass
 
 	class descript(object):
-		def __init__(self, f, expr, logger, message, prefix, levels):
+		def __init__(self, f, expr, logger, message, prefix, levels, phase):
 			self.f = f
 			self.expr = expr
 			self.logger = logger
 			self.prefix = prefix
 			self.message = message
 			self.levels = levels
+			self.phase = phase
+			# Everything that does not depend on the call is worked out once
+			argspec = inspect.getargspec(f)
+			self.guard = compile(expr, '<dryrun {0}>'.format(f.__name__), 'eval')
+			self.formatter = dryrun.Formatter(argspec)
+			# Names only used by the message, like reason, are not passed on
+			self.extra = ()
+			if not argspec.keywords:
+				names = set(re.split(r'[.\[]', name)[0] for literal, name, spec, conversion in self.formatter.parse(prefix + message) if name)
+				self.extra = tuple(names.difference(argspec.args))
 
 		def __get__(self, instance, klass):
-			if instance is not None:
-				return self.make_bound(instance)
+			if instance is None:
+				return self
+			return partial(self, instance)
 
 		def __call__(self, *args, **kwargs):
-			return self.run(None, args, kwargs)
-
-		def make_bound(self, instance):
-			@wraps(self.f)
-			def wrapper(*args, **kwargs):
-				return self.run(instance, (instance,) + args, kwargs)
-			setattr(instance, self.f.__name__, wrapper)
-			return wrapper
-
-		def run(self, instance, args, kwargs):
-			argspec = inspect.getargspec(self.f)
-			local = vars(instance) if instance else self.f.func_dict
-			if argspec.defaults:
-				local.update(dict(zip(argspec.args[-len(argspec.defaults):], argspec.defaults)))
-			local.update(dict(zip(argspec.args, args)))
-			local.update(kwargs)
-			dry_run = eval(self.expr, self.f.func_globals, local)
-			message = dryrun.Formatter(argspec).vformat((self.prefix if dry_run else u'') + self.message, args, kwargs)
-			self.logger.log(self.levels[0] if not dry_run else self.levels[1], message)
-			if not dry_run:
+			# The guard sees the arguments of the call, with self among them
+			dry_run = eval(self.guard, self.f.func_globals, self.formatter.namespace(args, kwargs))
+			level = self.levels[1] if dry_run else self.levels[0]
+			if self.logger.isEnabledFor(level):
+				self.logger.log(level, self.formatter.vformat((self.prefix if dry_run else u'') + self.message, args, kwargs))
+			if dry_run:
+				return
+			for name in self.extra:
+				kwargs.pop(name, None)
+			if not self.phase:
+				return self.f(*args, **kwargs)
+			with metrics.phase(self.phase):
 				return self.f(*args, **kwargs)
 
-	def __init__(self, expr, logger, message, prefix = u'[DRYRUN] ', levels = (logging.INFO, logging.WARN)):
+	def __init__(self, expr, logger, message, prefix = u'[DRYRUN] ', levels = (logging.INFO, logging.WARN), phase = None):
 		self.expr = expr
 		self.logger = logger
 		self.prefix = prefix
 		self.message = message
 		self.levels = levels
+		self.phase = phase
 
 	def __call__(self, f):
-		wrapper = dryrun.descript(f, self.expr, self.logger, self.message, self.prefix, self.levels)
+		wrapper = dryrun.descript(f, self.expr, self.logger, self.message, self.prefix, self.levels, self.phase)
 		wrapper.__name__ = f.__name__
 		wrapper.__doc__ = f.__doc__
 		wrapper.__dict__.update(f.__dict__)
@@ -0,0 +1,124 @@
+import struct, calendar, datetime, logging
+# datetime.strptime imports it lazily, which is not thread safe in Python 2
+import _strptime
+
+import pyexiv2
+
+LOG = logging.getLogger('exifdate')
+
+DATETIME = 0x0132
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 0x9003
+MAX_SEGMENTS = 32
+MAX_ENTRIES = 1024
+
+class UnsupportedLayout(Exception): pass
+
+class _Reader(object):
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read_at(self, offset, size):
+        self.f.seek(offset)
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        if len(data) != size:
+            raise UnsupportedLayout('Truncated file')
+        return data
+
+def _ifd(reader, base, offset, endian):
+    count = struct.unpack(endian + 'H', reader.read_at(base + offset, 2))[0]
+    if count > MAX_ENTRIES:
+        raise UnsupportedLayout('Too many IFD entries')
+    data = reader.read_at(base + offset + 2, count * 12)
+    entries = {}
+    for i in xrange(count):
+        tag, type, n = struct.unpack(endian + 'HHI', data[i * 12:i * 12 + 8])
+        entries[tag] = (type, n, data[i * 12 + 8:i * 12 + 12])
+    return entries
+
+def _ascii(reader, base, entry, endian):
+    type, n, value = entry
+    if type != 2:
+        return None
+    if n > 4:
+        value = reader.read_at(base + struct.unpack(endian + 'I', value)[0], n)
+    try:
+        return datetime.datetime.strptime(value[:n].split('\x00')[0].strip(), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+
+def _tiff(reader, base):
+    header = reader.read_at(base, 8)
+    if header[:4] == 'II*\x00':
+        endian = '<'
+    elif header[:4] == 'MM\x00*':
+        endian = '>'
+    else:
+        raise UnsupportedLayout('Not a TIFF header')
+    ifd0 = _ifd(reader, base, struct.unpack(endian + 'I', header[4:])[0], endian)
+    if DATETIME in ifd0:
+        value = _ascii(reader, base, ifd0[DATETIME], endian)
+        if value:
+            return value
+    if EXIF_IFD in ifd0:
+        exif = _ifd(reader, base, struct.unpack(endian + 'I', ifd0[EXIF_IFD][2])[0], endian)
+        if DATETIME_ORIGINAL in exif:
+            return _ascii(reader, base, exif[DATETIME_ORIGINAL], endian)
+    return None
+
+def _jpeg(reader):
+    offset = 2
+    for i in xrange(MAX_SEGMENTS):
+        marker, length = struct.unpack('>HH', reader.read_at(offset, 4))
+        if marker & 0xff00 != 0xff00:
+            raise UnsupportedLayout('Bad JPEG marker')
+        # EXIF is always before the image data
+        if marker in (0xffda, 0xffd9):
+            return None
+        if marker == 0xffe1 and length >= 14 and reader.read_at(offset + 4, 6) == 'Exif\x00\x00':
+            return _tiff(reader, offset + 10)
+        offset += 2 + length
+    raise UnsupportedLayout('Too many JPEG segments')
+
+def read_datetime(f):
+    # Reads IFD0 DateTime, or ExifIFD DateTimeOriginal if there is none,
+    # from the header of a JPEG or TIFF based (NEF, CR2, DNG...) file
+    # without reading the rest. Returns the datetime or None, and the
+    # number of bytes read. Raises UnsupportedLayout for anything else.
+    reader = _Reader(f)
+    magic = reader.read_at(0, 4)
+    if magic[:2] == '\xff\xd8':
+        value = _jpeg(reader)
+    elif magic in ('II*\x00', 'MM\x00*'):
+        value = _tiff(reader, 0)
+    else:
+        raise UnsupportedLayout('Unknown file type')
+    return value, reader.bytes_read
+
+def _pyexiv2_datetime(path):
+    metadata = pyexiv2.ImageMetadata(path)
+    try:
+        metadata.read()
+    except Exception:
+        return None
+    for key in ('Exif.Image.DateTime', 'Exif.Photo.DateTimeOriginal'):
+        try:
+            if key in metadata:
+                return metadata[key].value.timetuple()
+        except Exception:
+            pass
+    return None
+
+def timestamp(path):
+    try:
+        with open(path, 'rb') as f:
+            value = read_datetime(f)[0]
+        return calendar.timegm(value.timetuple()) if value else None
+    except (UnsupportedLayout, struct.error) as e:
+        LOG.debug(u'Reading EXIF of "{0}" with pyexiv2: {1}'.format(path, e))
+    except EnvironmentError:
+        return None
+    value = _pyexiv2_datetime(path)
+    return calendar.timegm(value) if value else None
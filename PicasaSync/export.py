@@ -0,0 +1,71 @@
+import os, json, threading, logging
+
+class Exporter(object):
+    # Writes the album export as a JSON object with one album per line, each
+    # album as soon as it is done, to a temporary file. On close the albums
+    # that were not written this time are copied from the previous export,
+    # line by line, and the new file replaces it. Neither export is ever
+    # held whole in memory.
+    LOG = logging.getLogger('Exporter')
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.lock = threading.Lock()
+        self.written = set()
+        self.kept = set()
+        self.keep_rest = False
+        self.out = open(self.tmp_path, 'w')
+        self.out.write('{')
+
+    def line(self, title, record):
+        if self.written:
+            self.out.write(',')
+        self.out.write('\n{0}: {1}'.format(json.dumps(title), json.dumps(record, sort_keys = True)))
+        self.written.add(title)
+
+    def write(self, title, record):
+        with self.lock:
+            self.line(title, record)
+
+    def keep(self, title):
+        # The album was not read this time, its last record still holds
+        with self.lock:
+            self.kept.add(title)
+
+    def previous(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        with f:
+            first = f.readline()
+            if first.strip() != '{':
+                # Written whole by older versions
+                f.seek(0)
+                for item in json.load(f).iteritems():
+                    yield item
+                return
+            for line in f:
+                line = line.strip().rstrip(',')
+                if line and line != '}':
+                    for item in json.loads('{' + line + '}').iteritems():
+                        yield item
+
+    def close(self):
+        with self.lock:
+            try:
+                for title, record in self.previous():
+                    if (self.keep_rest or title in self.kept) and title not in self.written:
+                        self.line(title, record)
+            except ValueError as e:
+                self.LOG.error(u'Cannot read the previous export "{0}": '.format(self.path) + str(e))
+            self.out.write('\n}\n')
+            self.out.close()
+            os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        # When the sync failed, the previous export is left as it was
+        with self.lock:
+            self.out.close()
+            os.remove(self.tmp_path)
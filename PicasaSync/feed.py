@@ -0,0 +1,134 @@
+import threading, urllib, urlparse, logging
+from xml.etree import cElementTree as ElementTree
+
+import gdata.photos
+from gdata.photos.service import GooglePhotosException
+
+LOG = logging.getLogger('FeedReader')
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+MAX_REDIRECTS = 4
+
+def album_from_element(element):
+    # Albums are few and Album works on the full entry
+    return gdata.photos.AlbumEntryFromString(ElementTree.tostring(element))
+
+class Page(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.entries = None
+        self.error = None
+
+class FeedReader(object):
+    # Reads a feed page by page, parsing each one with iterparse as it comes
+    # in and yielding its entries in feed order. Once the first page tells
+    # how many entries there are and how many go in a page, the remaining
+    # pages are requested at once from a few threads, so a large album takes
+    # about one round trip instead of one per page. Otherwise next links are
+    # followed.
+    PAGE_SIZE = 1000
+    THREADS = 4
+
+    def __init__(self, client, threads = THREADS, page_size = PAGE_SIZE):
+        self.client = client
+        self.threads = threads
+        self.page_size = page_size
+        # Set by Throttle.wrap, feed pages go through it like any API call
+        self.call = getattr(client, 'throttle', None) and client.throttle.call
+
+    def page_uri(self, uri, start):
+        parts = urlparse.urlsplit(uri)
+        query = [(k, v) for k, v in urlparse.parse_qsl(parts.query) if k not in ('start-index', 'max-results')]
+        query += [('start-index', str(start)), ('max-results', str(self.page_size))]
+        return urlparse.urlunsplit(parts[:3] + (urllib.urlencode(query), parts[4]))
+
+    def fetch_page(self, uri):
+        for redirect in xrange(MAX_REDIRECTS + 1):
+            response = self.client.request('GET', uri)
+            if response.status in (301, 302, 303, 307) and response.getheader('Location'):
+                response.read()
+                uri = response.getheader('Location')
+                continue
+            if response.status != 200:
+                raise GooglePhotosException({'status' : response.status, 'reason' : response.reason, 'body' : response.read()})
+            return response
+        raise GooglePhotosException({'status' : response.status, 'reason' : 'Too many redirects', 'body' : ''})
+
+    def open(self, uri):
+        if self.call:
+            return self.call(self.fetch_page, uri)
+        return self.fetch_page(uri)
+
+    def parse(self, response, convert, on_header = None):
+        # Yields the converted entries of one page. on_header(total, per_page,
+        # next_link) is called once, with what is known, at the first entry
+        # or the end of the page.
+        header = {}
+        for event, element in ElementTree.iterparse(response):
+            tag = element.tag
+            if tag == ATOM + 'entry':
+                if on_header and header is not None:
+                    on_header(header.get('totalResults'), header.get('itemsPerPage'), header.get('next'))
+                    header = None
+                yield convert(element)
+                element.clear()
+            elif header is None:
+                continue
+            elif tag.endswith('}totalResults') or tag.endswith('}itemsPerPage'):
+                header[tag.split('}')[1]] = int(element.text)
+            elif tag == ATOM + 'link' and element.get('rel') == 'next':
+                header['next'] = element.get('href')
+        if on_header and header is not None:
+            on_header(header.get('totalResults'), header.get('itemsPerPage'), header.get('next'))
+
+    def load(self, uri, pages, queue, lock, convert):
+        while True:
+            with lock:
+                if not queue:
+                    return
+                start = queue.pop(0)
+            page = pages[start]
+            try:
+                page.entries = list(self.parse(self.open(self.page_uri(uri, start)), convert))
+            except Exception as e:
+                page.error = e
+            finally:
+                page.done.set()
+
+    def read(self, uri, convert):
+        pages = {}
+        following = []
+        def on_header(total, per_page, next_link):
+            if total is None or not per_page:
+                # Without both the pages cannot be told apart, follow them
+                following.append(next_link)
+                return
+            starts = range(1 + per_page, total + 1, per_page)
+            if not starts:
+                return
+            LOG.debug(u'Fetching {0} more pages of "{1}"'.format(len(starts), uri))
+            for start in starts:
+                pages[start] = Page()
+            queue = list(starts)
+            lock = threading.Lock()
+            for i in xrange(min(self.threads, len(starts))):
+                worker = threading.Thread(target = self.load, args = (uri, pages, queue, lock, convert))
+                worker.daemon = True
+                worker.start()
+
+        for entry in self.parse(self.open(self.page_uri(uri, 1)), convert, on_header):
+            yield entry
+        for start in sorted(pages):
+            page = pages[start]
+            page.done.wait()
+            if page.error:
+                raise page.error
+            for entry in page.entries:
+                yield entry
+            page.entries = None
+        next_link = following and following[0]
+        while next_link:
+            following = []
+            for entry in self.parse(self.open(next_link), convert, lambda total, per_page, link: following.append(link)):
+                yield entry
+            next_link = following and following[0]
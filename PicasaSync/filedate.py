@@ -0,0 +1,68 @@
+import re, calendar, datetime, threading
+
+import dateutil.parser
+
+# Patterns that dateutil, given the text from its first digit on, is known to
+# parse into a full date. Anything else, including a different extension
+# which dateutil would take as one more token, goes through dateutil.
+EXTENSION = r'(?:\.(?:jpe?g|png|gif|bmp|nef))?$'
+recognizers = [
+        # IMG_20120304_101112.jpg, DSC_20120304101112.JPG, 20120304.jpg
+        re.compile(r'(\d{4})(\d{2})(\d{2})(?:_?(\d{2})(\d{2})(\d{2}))?' + EXTENSION, re.I),
+        # 2012-03-04.jpg, 2012-03-04T10:11:12.jpg
+        re.compile(r'(\d{4})-(\d{2})-(\d{2})(?:T(\d{2}):(\d{2}):(\d{2}))?' + EXTENSION, re.I),
+        ]
+FIRST_DIGIT = re.compile(r'\d')
+# Camera file counters, DSC_1234.JPG, DSCN1234.JPG, P1010001.JPG and the
+# like, which carry no date
+COUNTER = re.compile(r'(?:DSC[FN_]?|_DSC|IMG_|_MG_|SAM_|GOPR|P\d{3})\d{4}' + EXTENSION, re.I)
+# A date needs a four digit year, or a day, month and year
+DATE_DIGITS = re.compile(r'\d{4}|\d\D+\d+\D+\d')
+
+def _recognize(text):
+    for recognizer in recognizers:
+        m = recognizer.match(text)
+        if not m:
+            continue
+        year, a, b, hour, minute, second = [int(g or 0) for g in m.groups()]
+        # Like dateutil with dayfirst, a year is followed by the day unless
+        # that would leave an invalid month
+        day, month = (a, b) if b <= 12 else (b, a)
+        try:
+            return datetime.datetime(year, month, day, hour, minute, second)
+        except ValueError:
+            return None
+    return None
+
+def _parse(text):
+    # Tries dateutil from every digit on and keeps the first date it finds
+    for m in re.finditer(r'\d', text):
+        try:
+            return dateutil.parser.parse(m.string[m.start():], fuzzy = True, dayfirst = True)
+        except (ValueError, OverflowError):
+            pass
+    return None
+
+def timestamp(text):
+    m = FIRST_DIGIT.search(text)
+    if not m or not DATE_DIGITS.search(text, m.start()):
+        return None
+    name = text.rfind('/') + 1
+    if m.start() >= name and COUNTER.match(text, name):
+        return None
+    value = _recognize(text[m.start():]) or _parse(text)
+    return calendar.timegm(value.timetuple()) if value else None
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+def cached_timestamp(text):
+    # For directory paths, which are resolved again for every album split
+    # from them
+    with _memo_lock:
+        if text in _memo:
+            return _memo[text]
+    value = timestamp(text)
+    with _memo_lock:
+        _memo[text] = value
+    return value
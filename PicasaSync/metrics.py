@@ -0,0 +1,105 @@
+import os, time, json, threading, tempfile, collections, contextlib
+
+class Metrics(object):
+    # Collected from every thread during a run and written once at the end.
+    # Phases may run concurrently and nest (an upload includes its
+    # transform), so each one keeps both the time summed over all calls and
+    # the wall time from its first start to its last end. Errors are counted
+    # where they are logged.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.counters = collections.defaultdict(int)
+        self.calls = {}
+        self.errors = collections.defaultdict(int)
+        self.albums = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self.lock:
+                phase = self.phases.setdefault(name, {'count' : 0, 'seconds' : 0.0, 'first' : start, 'last' : end})
+                phase['count'] += 1
+                phase['seconds'] += end - start
+                phase['first'] = min(phase['first'], start)
+                phase['last'] = max(phase['last'], end)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def error(self, e):
+        with self.lock:
+            self.errors[type(e).__name__] += 1
+
+    def observe(self, name, seconds):
+        with self.lock:
+            call = self.calls.setdefault(name, {'count' : 0, 'seconds' : 0.0, 'max' : 0.0})
+            call['count'] += 1
+            call['seconds'] += seconds
+            call['max'] = max(call['max'], seconds)
+
+    def album(self, title, seconds):
+        with self.lock:
+            self.albums[title] = seconds
+
+    def summary(self):
+        with self.lock:
+            return {
+                    'started' : self.started,
+                    'seconds' : time.time() - self.started,
+                    'phases' : dict((name, {'count' : p['count'], 'seconds' : p['seconds'], 'wall_seconds' : p['last'] - p['first']}) for name, p in self.phases.iteritems()),
+                    'counters' : dict(self.counters),
+                    'api_calls' : dict((name, dict(c)) for name, c in self.calls.iteritems()),
+                    'errors' : dict(self.errors),
+                    'albums' : dict(self.albums),
+                    }
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = []
+        def metric(name, help, values):
+            lines.append('# HELP picasasync_{0} {1}'.format(name, help))
+            lines.append('# TYPE picasasync_{0} gauge'.format(name))
+            for labels, value in values:
+                label = ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in labels)
+                lines.append('picasasync_{0}{1} {2!r}'.format(name, '{' + label + '}' if label else '', float(value)))
+        metric('run_start_timestamp_seconds', 'Start time of the last run', [((), summary['started'])])
+        metric('run_seconds', 'Duration of the last run', [((), summary['seconds'])])
+        metric('phase_seconds', 'Time spent in each phase, summed over all threads', [((('phase', k),), v['seconds']) for k, v in sorted(summary['phases'].iteritems())])
+        metric('phase_wall_seconds', 'Time from the first start to the last end of each phase', [((('phase', k),), v['wall_seconds']) for k, v in sorted(summary['phases'].iteritems())])
+        metric('phase_calls', 'Number of times each phase ran', [((('phase', k),), v['count']) for k, v in sorted(summary['phases'].iteritems())])
+        metric('events', 'Counters of the last run', [((('name', k),), v) for k, v in sorted(summary['counters'].iteritems())])
+        metric('api_calls', 'API calls by operation', [((('operation', k),), v['count']) for k, v in sorted(summary['api_calls'].iteritems())])
+        metric('api_seconds', 'Time of API calls by operation, summed', [((('operation', k),), v['seconds']) for k, v in sorted(summary['api_calls'].iteritems())])
+        metric('api_seconds_max', 'Slowest API call by operation', [((('operation', k),), v['max']) for k, v in sorted(summary['api_calls'].iteritems())])
+        metric('errors', 'Errors by exception type', [((('type', k),), v) for k, v in sorted(summary['errors'].iteritems())])
+        albums = summary['albums'].values()
+        metric('albums', 'Number of albums synced', [((), len(albums))])
+        metric('album_seconds', 'Time spent syncing albums, summed', [((), sum(albums))])
+        metric('album_seconds_max', 'Slowest album', [((), max(albums) if albums else 0)])
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        _write(path, json.dumps(self.summary(), indent = 1, sort_keys = True) + '\n')
+
+    def write_prometheus(self, path):
+        _write(path, self.prometheus())
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').encode('utf-8')
+
+def _write(path, data):
+    # Written aside and renamed, so collectors never read half a file
+    fd, tmp = tempfile.mkstemp(prefix = '.' + os.path.basename(path), dir = os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+
+metrics = Metrics()
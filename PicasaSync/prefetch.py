@@ -0,0 +1,108 @@
+import threading, collections, logging
+
+from metrics import metrics
+
+class Prefetch(object):
+    def __init__(self, album):
+        self.album = album
+        self.done = threading.Event()
+        self.claimed = False
+        self.records = None
+        self.error = None
+
+class FeedPrefetcher(object):
+    # Reads the photo feeds of albums ahead of the workers that sync them,
+    # in the order the albums were submitted. A feed that has been read but
+    # not taken yet holds one of depth slots, so however far behind the
+    # workers are, at most depth albums' records wait in memory.
+    LOG = logging.getLogger('FeedPrefetcher')
+    THREADS = 2
+
+    def __init__(self, clients, depth, threads = THREADS):
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.fetches = {}
+        self.slots = threading.Semaphore(depth)
+        self.closed = False
+        self.workers = []
+        for i in xrange(threads):
+            worker = threading.Thread(target = self.work, args = (clients[i % len(clients)],))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, album):
+        with self.cond:
+            if self.closed or album.title in self.pending or album.title in self.fetches:
+                return
+            self.pending[album.title] = album
+            self.cond.notify()
+
+    def claim(self, fetch):
+        # With self.cond held. The slot is freed once the feed is both read
+        # and taken or discarded, whichever comes last.
+        fetch.claimed = True
+        if fetch.done.is_set():
+            self.slots.release()
+
+    def take(self, title):
+        # The records of the album, or None when its feed is not being read
+        # ahead and the caller has to read it itself
+        with self.cond:
+            if self.pending.pop(title, None):
+                return None
+            fetch = self.fetches.pop(title, None)
+            if fetch is None:
+                return None
+            self.claim(fetch)
+        fetch.done.wait()
+        if fetch.error:
+            raise fetch.error
+        return fetch.records
+
+    def discard(self, title):
+        with self.cond:
+            self.pending.pop(title, None)
+            fetch = self.fetches.pop(title, None)
+            if fetch:
+                self.claim(fetch)
+
+    def next(self):
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return None
+            title, album = self.pending.popitem(last = False)
+            fetch = self.fetches[title] = Prefetch(album)
+            return fetch
+
+    def work(self, client):
+        while True:
+            self.slots.acquire()
+            fetch = self.next()
+            if fetch is None:
+                self.slots.release()
+                break
+            try:
+                with metrics.phase('prefetch'):
+                    fetch.records = list(fetch.album.feed(client))
+            except Exception as e:
+                # Raised to the worker that takes the album
+                self.LOG.debug(u'Error reading album "{0}" ahead: '.format(fetch.album.title) + str(e))
+                fetch.error = e
+            with self.cond:
+                fetch.done.set()
+                if fetch.claimed:
+                    self.slots.release()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.pending.clear()
+            for fetch in self.fetches.values():
+                self.claim(fetch)
+            self.fetches.clear()
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
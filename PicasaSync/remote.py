@@ -0,0 +1,68 @@
+ATOM = '{http://www.w3.org/2005/Atom}'
+GPHOTO = '{http://schemas.google.com/photos/2007}'
+MEDIA = '{http://search.yahoo.com/mrss/}'
+
+def _text(element):
+    return element.text if element is not None else None
+
+def _int(element):
+    try:
+        return int(element.text)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class RemotePhoto(object):
+    # What the sync needs from a Picasa photo entry. The entries themselves
+    # are trees of XML-derived objects many times larger, and are fetched
+    # again by edit link when a photo is actually updated.
+    __slots__ = ('id', 'title', 'timestamp', 'src', 'mimetype', 'thumbnails', 'summary', 'edit_link', 'size', 'checksum')
+
+    def __init__(self, id, title, timestamp, src = None, mimetype = None, thumbnails = (), summary = None, edit_link = None, size = None, checksum = None):
+        self.id = id
+        self.title = title
+        self.timestamp = timestamp
+        self.src = src
+        self.mimetype = mimetype
+        self.thumbnails = thumbnails
+        self.summary = summary
+        self.edit_link = edit_link
+        self.size = size
+        self.checksum = checksum
+
+    @classmethod
+    def from_entry(cls, entry):
+        content = entry.content
+        media = entry.media
+        edit_link = entry.GetEditLink()
+        return cls(
+                entry.gphoto_id.text,
+                entry.title.text,
+                int(long(entry.timestamp.text) / 1000),
+                content.src if content is not None else None,
+                content.type if content is not None else None,
+                tuple(t.url for t in media.thumbnail) if media is not None and media.thumbnail else (),
+                _text(entry.summary),
+                edit_link.href if edit_link is not None else None,
+                _int(entry.size),
+                _text(entry.checksum) or None)
+
+    @classmethod
+    def from_element(cls, element):
+        # Straight from a feed entry parsed with ElementTree, see feed.py
+        content = element.find(ATOM + 'content')
+        edit_link = [link.get('href') for link in element.findall(ATOM + 'link') if link.get('rel') == 'edit']
+        timestamp = element.findtext(GPHOTO + 'timestamp')
+        return cls(
+                element.findtext(GPHOTO + 'id'),
+                element.findtext(ATOM + 'title'),
+                int(long(timestamp) / 1000) if timestamp else None,
+                content.get('src') if content is not None else None,
+                content.get('type') if content is not None else None,
+                tuple(t.get('url') for t in element.findall(MEDIA + 'group/' + MEDIA + 'thumbnail')),
+                element.findtext(ATOM + 'summary'),
+                edit_link[0] if edit_link else None,
+                _int(element.find(GPHOTO + 'size')),
+                element.findtext(GPHOTO + 'checksum') or None)
+
+    def __repr__(self):
+        return '<RemotePhoto {0} "{1}">'.format(self.id, self.title)
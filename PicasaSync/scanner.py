@@ -0,0 +1,108 @@
+import os, mimetypes, threading, time, functools, logging
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+from scheduler import Scheduler, TaskGroup
+from metrics import metrics
+
+def extension_table(types):
+    table = {}
+    for ext, mimetype in mimetypes.types_map.iteritems():
+        if mimetype in types:
+            table[ext.lower()] = mimetype
+    return table
+
+class DiskScanner(object):
+    LOG = logging.getLogger('DiskScanner')
+    BATCH_SIZE = 64
+
+    def __init__(self, types, threads = 1):
+        self.extensions = extension_table(types)
+        self.threads = max(threads, 1)
+        self.lock = threading.Lock()
+
+    def mimetype(self, name):
+        return self.extensions.get(os.path.splitext(name)[1].lower())
+
+    def listdir(self, path):
+        # Returns the supported files in path with their stat results and the
+        # subdirectories to descend into. Like os.walk, unreadable
+        # directories are skipped and symlinked directories not followed.
+        files, dirs = [], []
+        try:
+            if scandir:
+                for entry in scandir(path):
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                dirs.append(entry.path)
+                        elif self.mimetype(entry.name):
+                            files.append((entry.name, entry.stat()))
+                    except OSError:
+                        if self.mimetype(entry.name):
+                            files.append((entry.name, None))
+            else:
+                for name in os.listdir(path):
+                    full_path = os.path.join(path, name)
+                    if os.path.isdir(full_path):
+                        if not os.path.islink(full_path):
+                            dirs.append(full_path)
+                    elif self.mimetype(name):
+                        try:
+                            files.append((name, os.stat(full_path)))
+                        except OSError:
+                            files.append((name, None))
+        except OSError as e:
+            self.LOG.debug(u'Cannot list directory "{0}": {1}'.format(path, e))
+        return files, dirs
+
+    def scan(self, path, resolve, on_directory = None):
+        # Walks path with a pool of threads. resolve(root, name, st) is called
+        # from the workers for every supported file. Returns a dict mapping
+        # each directory with supported files to its (name, resolved) pairs
+        # sorted by name, with None in place of the files that failed.
+        # on_directory(root, pairs) is called as soon as each of them is
+        # complete.
+        self.on_directory = on_directory
+        self.directories = {}
+        self.files = 0
+        start = time.time()
+        with metrics.phase('scan'):
+            scheduler = Scheduler([None] * self.threads, 0)
+            group = TaskGroup()
+            scheduler.submit(group, self.scan_directory, scheduler, group, path, resolve)
+            group.close()
+            scheduler.join()
+        elapsed = time.time() - start
+        metrics.count('files_scanned', self.files)
+        self.LOG.info(u'Scanned {0} files in {1} directories of "{2}" in {3:.1f}s ({4:.0f} files/s)'.format(self.files, len(self.directories), path, elapsed, self.files / elapsed if elapsed else 0))
+        return self.directories
+
+    def scan_directory(self, scheduler, group, root, resolve):
+        files, dirs = self.listdir(root)
+        # Registered before descending, so whether a directory has photos is
+        # known by the time any of its subdirectories is complete
+        if files:
+            files.sort()
+            results = [None] * len(files)
+            with self.lock:
+                self.directories[root] = results
+                self.files += len(files)
+        for path in dirs:
+            scheduler.submit(group, self.scan_directory, scheduler, group, path, resolve)
+        if not files:
+            return
+        directory = TaskGroup(self.on_directory and functools.partial(self.on_directory, root, results))
+        for i in xrange(0, len(files), self.BATCH_SIZE):
+            scheduler.submit(directory, self.resolve, files[i:i + self.BATCH_SIZE], results, i, root, resolve)
+        directory.close()
+
+    def resolve(self, files, results, offset, root, resolve):
+        for i, (name, st) in enumerate(files):
+            try:
+                results[offset + i] = (name, resolve(root, name, st))
+            except Exception:
+                self.LOG.exception(u'Error scanning file "{0}"'.format(os.path.join(root, name)))
@@ -0,0 +1,93 @@
+import threading, Queue, logging
+
+from metrics import metrics
+
+class TaskGroup(object):
+    def __init__(self, on_done = None):
+        self.lock = threading.Lock()
+        self.pending = 1
+        self.failed = False
+        self.on_done = on_done
+
+    def add(self):
+        with self.lock:
+            self.pending += 1
+
+    def done(self):
+        with self.lock:
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished and self.on_done:
+            self.on_done()
+
+    close = done
+
+class Scheduler(object):
+    LOG = logging.getLogger('Scheduler')
+
+    def __init__(self, clients, queue_size):
+        self.queue = Queue.Queue(queue_size)
+        self.local = threading.local()
+        self.idle = threading.Condition()
+        self.outstanding = 0
+        self.workers = []
+        for client in clients:
+            worker = threading.Thread(target = self.work, args = (client,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    @apply
+    def client():
+        def fget(self):
+            return getattr(self.local, 'client', None)
+        return property(**locals())
+
+    def submit(self, group, func, *args, **kwargs):
+        group.add()
+        with self.idle:
+            self.outstanding += 1
+        task = (group, func, args, kwargs)
+        if self.client is None:
+            self.queue.put(task)
+        else:
+            # Workers never block on a full queue, they run the task themselves
+            try:
+                self.queue.put_nowait(task)
+            except Queue.Full:
+                self.run(task)
+
+    def run(self, task):
+        group, func, args, kwargs = task
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            self.LOG.exception(u'Unhandled error running task')
+            metrics.error(e)
+            group.failed = True
+        finally:
+            try:
+                group.done()
+            except Exception:
+                self.LOG.exception(u'Unhandled error finishing task group')
+            with self.idle:
+                self.outstanding -= 1
+                if self.outstanding == 0:
+                    self.idle.notify_all()
+
+    def work(self, client):
+        self.local.client = client
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            self.run(task)
+
+    def join(self):
+        with self.idle:
+            while self.outstanding:
+                self.idle.wait(1)
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
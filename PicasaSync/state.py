@@ -0,0 +1,167 @@
+import os, sqlite3, threading, logging
+
+from cache import content_hash
+
+class StateStore(object):
+    LOG = logging.getLogger('StateStore')
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.text_factory = unicode
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, origins TEXT, timestamp INTEGER, origin TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS etags (path TEXT PRIMARY KEY, url TEXT, etag TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, sha1 TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS photos (path TEXT PRIMARY KEY, photo_id TEXT, sha1 TEXT, remote_size INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS albums (title TEXT PRIMARY KEY, album_id TEXT, updated TEXT, numphotos INTEGER, mode TEXT, files_sha1 TEXT, files INTEGER, max_mtime REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY, action TEXT, album TEXT, path TEXT, target TEXT, done INTEGER)')
+        self.db.commit()
+
+    def _changed(self):
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending = 0
+
+    def lookup_scan(self, path, st, origins):
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, inode, origins, timestamp, origin FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[:4] == (st.st_size, st.st_mtime, st.st_ino, u','.join(origins)):
+            return row[4], row[5]
+        return None
+
+    def store_scan(self, path, st, origins, timestamp, origin):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', (path, st.st_size, st.st_mtime, st.st_ino, u','.join(origins), timestamp, origin))
+            self._changed()
+
+    def lookup_etag(self, path, url):
+        with self.lock:
+            row = self.db.execute('SELECT url, etag FROM etags WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == url:
+            return row[1]
+        return None
+
+    def store_etag(self, path, url, etag):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO etags VALUES (?, ?, ?)', (path, url, etag))
+            self._changed()
+
+    def content_hash(self, path):
+        # Only files whose stat tuple changed since they were last hashed
+        # are read again
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, inode, sha1 FROM hashes WHERE path = ?', (path,)).fetchone()
+        if row and row[:3] == (st.st_size, st.st_mtime, st.st_ino):
+            return row[3]
+        sha1 = content_hash(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', (path, st.st_size, st.st_mtime, st.st_ino, sha1))
+            self._changed()
+        return sha1
+
+    def lookup_photo(self, path):
+        with self.lock:
+            return self.db.execute('SELECT photo_id, sha1, remote_size FROM photos WHERE path = ?', (os.path.abspath(path),)).fetchone()
+
+    def store_photo(self, path, photo_id, sha1, remote_size):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?)', (os.path.abspath(path), photo_id, sha1, remote_size))
+            self._changed()
+
+    def lookup_album(self, title):
+        with self.lock:
+            return self.db.execute('SELECT album_id, updated, numphotos, mode, files_sha1, files, max_mtime FROM albums WHERE title = ?', (title,)).fetchone()
+
+    def store_album(self, title, album_id, updated, numphotos, mode, files_sha1, files, max_mtime):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO albums VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (title, album_id, updated, numphotos, mode, files_sha1, files, max_mtime))
+            self._changed()
+
+    # The journal is a write-ahead record of what a sync set out to do and
+    # how far it got. A plan row opens each run, then every album to sync
+    # gets a row before any work on it starts, and every album creation and
+    # photo upload, download and deletion one before it is attempted. Rows
+    # are marked done once their action succeeded. Unlike the rest of the
+    # index each change is committed at once, so a killed run leaves exactly
+    # the albums it did not finish. Rows of older runs are dropped once a
+    # new plan is complete.
+
+    def _commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def record_action(self, action, album = None, path = None, target = None):
+        with self.lock:
+            row = self.db.execute('INSERT INTO journal (action, album, path, target, done) VALUES (?, ?, ?, ?, 0)', (action, album, path, target)).lastrowid
+            self._commit()
+            return row
+
+    def finish_action(self, row, target = None):
+        with self.lock:
+            if target is None:
+                self.db.execute('UPDATE journal SET done = 1 WHERE id = ?', (row,))
+            else:
+                self.db.execute('UPDATE journal SET done = 1, target = ? WHERE id = ?', (target, row))
+            self._commit()
+
+    def begin_plan(self):
+        return self.record_action('plan')
+
+    def end_plan(self, row):
+        # Every album of the run is in the journal now, what older runs left
+        # is either among them or not wanted anymore
+        with self.lock:
+            self.db.execute('DELETE FROM journal WHERE id < ?', (row,))
+            self.db.execute('UPDATE journal SET done = 1 WHERE id = ?', (row,))
+            self._commit()
+
+    def last_run(self):
+        # The rows of the last run as (action, album, path, target, done)
+        # tuples, None when there is none, and whether it got to plan all
+        # its albums
+        with self.lock:
+            plan = self.db.execute("SELECT id, done FROM journal WHERE action = 'plan' ORDER BY id DESC LIMIT 1").fetchone()
+            if plan is None:
+                return None, False
+            rows = self.db.execute('SELECT action, album, path, target, done FROM journal WHERE id > ? ORDER BY id', (plan[0],)).fetchall()
+        return rows, bool(plan[1])
+
+    def prune_journal(self):
+        # After a sync that ran to its end, only the albums that failed are
+        # left to resume
+        with self.lock:
+            self.db.execute("DELETE FROM journal WHERE done = 1 AND action != 'plan'")
+            if not self.db.execute("SELECT 1 FROM journal WHERE action != 'plan' LIMIT 1").fetchone():
+                self.db.execute('DELETE FROM journal')
+            self._commit()
+
+    def rebuild(self):
+        with self.lock:
+            self.db.execute('DELETE FROM files')
+            self.db.execute('DELETE FROM hashes')
+            self.db.execute('DELETE FROM albums')
+            self.db.commit()
+            self.pending = 0
+
+    def compact(self):
+        with self.lock:
+            stale = [(path,) for (path,) in self.db.execute('SELECT path FROM files UNION SELECT path FROM hashes UNION SELECT path FROM photos UNION SELECT path FROM etags') if not os.path.exists(path)]
+            for table in ('files', 'hashes', 'photos', 'etags'):
+                self.db.executemany('DELETE FROM %s WHERE path = ?' % table, stale)
+            self.db.commit()
+            self.pending = 0
+            self.db.execute('VACUUM')
+        self.LOG.info(u'Removed {0} stale entries from "{1}"'.format(len(stale), self.path))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,108 @@
+import time, errno, random, socket, httplib, threading, functools, logging
+
+import gdata.service
+from gdata.photos.service import GooglePhotosException
+
+from metrics import metrics
+
+LOG = logging.getLogger('Throttle')
+
+# Answers that mean the server wants fewer or slower requests
+THROTTLE_STATUS = (429, 503)
+
+def throttled(e):
+    if isinstance(e, GooglePhotosException):
+        status, body = e.error_code, e.body
+    elif isinstance(e, gdata.service.RequestError) and e.args and isinstance(e.args[0], dict):
+        status, body = e.args[0].get('status'), str(e.args[0].get('body', ''))
+    else:
+        return False
+    return status in THROTTLE_STATUS or (status == 403 and 'quota' in body.lower())
+
+def dropped(e):
+    # A server that throttles may answer before it has read the request
+    # and close the connection, which then fails instead of the status
+    if isinstance(e, socket.error):
+        return e.errno in (errno.EPIPE, errno.ECONNRESET)
+    return isinstance(e, httplib.BadStatusLine)
+
+class Throttle(object):
+    # Limits the API requests in flight over all the clients. The limit grows
+    # by about one for every limit's worth of successful requests and halves
+    # when the server throttles a request (AIMD), so it settles near what the
+    # server accepts. Throttled requests are retried after an exponential
+    # backoff with full jitter.
+    METHODS = ('GetFeed', 'GetNext', 'GetEntry', 'InsertAlbum', 'InsertPhoto', 'UpdatePhotoBlob', 'UpdatePhotoMetadata', 'Delete')
+    BASE_DELAY = 1.0
+    MAX_DELAY = 60.0
+
+    def __init__(self, limit, retries = 5):
+        self.cond = threading.Condition()
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.inflight = 0
+        self.retries = retries
+        # Bumped on every decrease, so the requests that were already in
+        # flight under the old limit do not halve it again
+        self.epoch = 0
+        self.last_throttled = 0
+
+    def wrap(self, client):
+        # Set on the instance, so calls the client makes to itself, like
+        # GetEntries to GetFeed, go through the throttle too
+        for name in self.METHODS:
+            setattr(client, name, functools.partial(self.call, getattr(client, name)))
+        client.throttle = self
+        return client
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+            return self.epoch
+
+    def release(self, epoch, throttled):
+        with self.cond:
+            self.inflight -= 1
+            if throttled:
+                self.last_throttled = time.time()
+                if epoch == self.epoch:
+                    self.epoch += 1
+                    self.limit = max(1.0, self.limit / 2)
+                    LOG.info(u'Server is throttling, allowing {0} requests in flight'.format(int(self.limit)))
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.MAX_DELAY, self.BASE_DELAY * 2 ** attempt))
+
+    def throttling(self):
+        # The server throttled a request within the longest backoff
+        with self.cond:
+            return time.time() - self.last_throttled < self.MAX_DELAY
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            epoch = self.acquire()
+            busy = False
+            # Timed by operation, a GET may be a feed page or a single entry
+            # and a POST an album or a photo. Each attempt counts on its own.
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                busy = throttled(e) or (dropped(e) and self.throttling())
+                if busy:
+                    metrics.count('throttled')
+                if not busy or attempt >= self.retries:
+                    raise
+            finally:
+                metrics.observe(func.__name__, time.time() - start)
+                self.release(epoch, busy)
+            delay = self.delay(attempt)
+            LOG.debug(u'Retrying {0} in {1:.1f}s after being throttled'.format(func.__name__, delay))
+            time.sleep(delay)
+            attempt += 1
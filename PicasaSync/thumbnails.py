@@ -0,0 +1,81 @@
+import os, threading, Queue, logging
+
+import transfer
+from metrics import metrics
+
+class ThumbnailFetcher(object):
+    LOG = logging.getLogger('ThumbnailFetcher')
+
+    def __init__(self, threads, state = None, queue_size = 64):
+        self.state = state
+        self.queue = Queue.Queue(queue_size)
+        self.workers = []
+        for i in xrange(threads):
+            worker = threading.Thread(target = self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    @staticmethod
+    def is_current(path, timestamp):
+        # Thumbnails get the timestamp of their Picasa entry as mtime
+        try:
+            return int(os.stat(path).st_mtime) == timestamp
+        except EnvironmentError:
+            return False
+
+    def submit(self, url, path, timestamp, album = None, done = None):
+        # The album is not done, and not recorded as synced, before its
+        # thumbnails are. done is called once the thumbnail is on disk.
+        if album is not None and album.group:
+            album.group.add()
+        self.queue.put((url, path, timestamp, album, done))
+
+    def fetch(self, url, path, timestamp):
+        if self.is_current(path, timestamp):
+            return
+        etag = None
+        if self.state and os.path.exists(path):
+            etag = self.state.lookup_etag(path, url)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        modified, etag = transfer.fetch_if_modified(url, path + '.part', etag)
+        if modified:
+            os.rename(path + '.part', path)
+        else:
+            self.LOG.debug(u'Thumbnail "{0}" not modified'.format(path))
+        os.utime(path, (timestamp, timestamp))
+        if self.state and etag:
+            self.state.store_etag(path, url, etag)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                url, path, timestamp, album, done = item
+                self.fetch(url, path, timestamp)
+                if done:
+                    done()
+            except Exception as e:
+                # Anything else would end the worker and leave join() waiting
+                self.LOG.error(u'Error downloading thumbnail "{0}": '.format(path) + str(e))
+                if album is not None:
+                    album.error(e)
+                else:
+                    metrics.error(e)
+            finally:
+                try:
+                    if item and album is not None and album.group:
+                        album.group.done()
+                finally:
+                    self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
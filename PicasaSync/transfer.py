@@ -0,0 +1,294 @@
+import os, re, urlparse, httplib, socket, select, threading, collections, logging
+
+import atom.http
+
+from metrics import metrics
+
+LOG = logging.getLogger('transfer')
+
+CHUNK_SIZE = 64 * 1024
+RETRIES = 3
+PARALLEL_MIN_SIZE = 8 * 1024 * 1024
+MAX_REDIRECTS = 5
+SOURCE_SUFFIX = '.src'
+
+class TransferError(IOError): pass
+
+class ConnectionPool(object):
+    # Keep-alive connections are owned by the thread that opened them, so
+    # every worker reuses its own connections and the number of open
+    # connections follows the number of threads.
+    def __init__(self, max_hosts = 4):
+        self.max_hosts = max_hosts
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _usable(self, connection):
+        if connection.sock is None:
+            return False
+        if connection._HTTPConnection__state != httplib._CS_IDLE:
+            return False
+        response = connection._HTTPConnection__response
+        if response and not response.isclosed():
+            return False
+        # An idle socket that is readable has been closed by the server
+        return not select.select([connection.sock], [], [], 0)[0]
+
+    def get(self, scheme, host, port = None):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = collections.OrderedDict()
+        key = (scheme, host, port)
+        connection = connections.pop(key, None)
+        if connection and self._usable(connection):
+            with self.lock:
+                self.reused += 1
+        else:
+            if connection:
+                connection.close()
+            connection = (httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection)(host, port)
+            with self.lock:
+                self.created += 1
+        connections[key] = connection
+        while len(connections) > self.max_hosts:
+            connections.popitem(last = False)[1].close()
+        return connection
+
+    def stats(self):
+        with self.lock:
+            return {'created' : self.created, 'reused' : self.reused}
+
+pool = ConnectionPool()
+
+class PooledHttpClient(atom.http.ProxiedHttpClient):
+    def _prepare_connection(self, url, headers):
+        if os.environ.get('%s_proxy' % url.protocol):
+            return atom.http.ProxiedHttpClient._prepare_connection(self, url, headers)
+        return pool.get(url.protocol, url.host, int(url.port) if url.port else None)
+
+def _request(method, url, headers = None):
+    for redirect in xrange(MAX_REDIRECTS):
+        parts = urlparse.urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        for attempt in (0, 1):
+            connection = pool.get(parts.scheme, parts.hostname, parts.port)
+            reused = connection.sock is not None
+            try:
+                connection.request(method, path, headers = headers or {})
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # A kept-alive connection may have gone away, try a fresh one
+                if not reused or attempt:
+                    raise
+        if response.status in (301, 302, 303, 307) and response.getheader('Location'):
+            response.read()
+            url = urlparse.urljoin(url, response.getheader('Location'))
+            continue
+        return response
+    raise TransferError('Too many redirects downloading "{0}"'.format(url))
+
+def _copy(response, f):
+    received = 0
+    try:
+        while True:
+            data = response.read(CHUNK_SIZE)
+            if not data:
+                break
+            f.write(data)
+            received += len(data)
+    finally:
+        metrics.count('bytes_down', received)
+
+def _get(url, start = 0, end = None, validator = None):
+    headers = {}
+    if start or end is not None:
+        headers['Range'] = 'bytes=%d-%s' % (start, '' if end is None else end)
+        if validator:
+            # The server sends the whole resource instead if it changed
+            headers['If-Range'] = validator
+    return _request('GET', url, headers)
+
+def _validator(response):
+    # What the resource can be told apart by in If-Range, which takes no
+    # weak ETags
+    etag = response.getheader('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.getheader('Last-Modified')
+
+def _read_source(dest):
+    # The URL and validator of the resource the partial data in dest
+    # belongs to, kept next to it so another run can check them
+    try:
+        with open(dest + SOURCE_SUFFIX) as f:
+            url, validator = f.read().split('\n', 1)
+    except (EnvironmentError, ValueError):
+        return None, None
+    return url, validator or None
+
+def _write_source(dest, url, validator):
+    with open(dest + SOURCE_SUFFIX, 'w') as f:
+        f.write('{0}\n{1}'.format(url, validator or ''))
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def _content_range(response):
+    m = re.match(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)', response.getheader('Content-Range', ''))
+    if not m:
+        return None
+    return tuple(None if g in (None, '*') else int(g) for g in m.groups())
+
+def _fetch_range(url, dest, start = 0, end = None, validator = None):
+    # Fetches bytes start..end (inclusive, None meaning up to the end of the
+    # resource) into dest, resuming from whatever dest already holds as
+    # long as the resource still matches validator. A whole download
+    # keeps the validator of what it fetched next to dest.
+    # Returns the total size of the resource if the server told it.
+    total = None
+    whole = start == 0 and end is None
+    for attempt in xrange(RETRIES):
+        offset = os.path.getsize(dest) if os.path.exists(dest) else 0
+        if end is not None and start + offset > end + 1:
+            # Left over from something else, it cannot be this range
+            os.remove(dest)
+            offset = 0
+        if end is not None and start + offset == end + 1:
+            return total
+        try:
+            response = _get(url, start + offset, end, validator)
+            content_range = _content_range(response)
+            if response.status == 416:
+                response.read()
+                # Nothing left to fetch past what we already have, unless
+                # it is a different resource of the same size
+                if content_range and content_range[2] == start + offset and _validator(response) in (None, validator):
+                    return content_range[2]
+                _remove(dest)
+                continue
+            elif response.status == 206 and content_range and content_range[0] == start + offset:
+                mode = 'ab'
+                total = content_range[2]
+            elif response.status == 200 and whole:
+                mode = 'wb'
+                length = response.getheader('Content-Length')
+                total = int(length) if length else None
+                validator = _validator(response)
+                _write_source(dest, url, validator)
+            else:
+                response.read()
+                if response.status == 200 and validator:
+                    raise TransferError('"{0}" changed during the download'.format(url))
+                if response.status == 200:
+                    raise TransferError('Server does not support range requests for "{0}"'.format(url))
+                raise TransferError('Error {0} {1} downloading "{2}"'.format(response.status, response.reason, url))
+            with open(dest, mode) as f:
+                _copy(response, f)
+        except (httplib.HTTPException, socket.error) as e:
+            LOG.debug(u'Retrying interrupted download of "{0}": {1!r}'.format(url, e))
+            continue
+        expected = (end + 1 - start) if end is not None else (total - start if total is not None else None)
+        size = os.path.getsize(dest)
+        if expected is None or size == expected:
+            return total
+        if size > expected:
+            os.remove(dest)
+        LOG.debug(u'Retrying short download of "{0}": got {1} of {2} bytes'.format(url, size, expected))
+    raise TransferError('Giving up downloading "{0}" after {1} attempts'.format(url, RETRIES))
+
+def _pieces(dest):
+    # The range files of a split download of dest
+    directory, name = os.path.split(dest)
+    pattern = re.compile(re.escape(name) + r'\.\d+-\d+$')
+    return [os.path.join(directory, f) for f in os.listdir(directory or '.') if pattern.match(f)]
+
+def _fetch_parallel(url, dest, total, segments, validator = None):
+    size = (total + segments - 1) / segments
+    ranges = [(i * size, min(total, (i + 1) * size) - 1) for i in xrange(segments)]
+    # Named by range, so a download split differently never reuses them
+    paths = ['{0}.{1}-{2}'.format(dest, start, end) for start, end in ranges]
+    for path in set(_pieces(dest)) - set(paths):
+        os.remove(path)
+    errors = []
+    def worker(path, start, end):
+        try:
+            _fetch_range(url, path, start, end, validator)
+        except EnvironmentError as e:
+            errors.append(e)
+    threads = [threading.Thread(target = worker, args = (path, start, end)) for (path, (start, end)) in zip(paths, ranges)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    with open(dest, 'wb') as f:
+        for path in paths:
+            with open(path, 'rb') as part:
+                while True:
+                    data = part.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+    for path in paths:
+        os.remove(path)
+    if os.path.getsize(dest) != total:
+        os.remove(dest)
+        raise TransferError('Download of "{0}" assembled to the wrong size'.format(url))
+
+def fetch(url, dest, segments = 1):
+    # Downloads url into dest. An existing dest is taken as the beginning of
+    # the resource and the download resumes after it, if it is known to
+    # come from the same URL and the server confirms with If-Range that
+    # the resource did not change since. Large fresh downloads may be
+    # split into several parallel range requests.
+    source, validator = _read_source(dest)
+    if source != url or not validator:
+        # Partial data from an unknown or unverifiable version
+        validator = None
+        for path in [dest] + _pieces(dest):
+            _remove(path)
+    if segments > 1 and not os.path.exists(dest):
+        try:
+            response = _request('HEAD', url)
+            response.read()
+            length = response.status == 200 and response.getheader('Content-Length')
+            ranges = response.getheader('Accept-Ranges', '')
+            current = _validator(response)
+        except (httplib.HTTPException, socket.error):
+            length = None
+        if length and int(length) >= PARALLEL_MIN_SIZE and 'bytes' in ranges:
+            if current != validator:
+                for path in _pieces(dest):
+                    os.remove(path)
+            _write_source(dest, url, current)
+            _fetch_parallel(url, dest, int(length), segments, current)
+            _remove(dest + SOURCE_SUFFIX)
+            return
+    _fetch_range(url, dest, validator = validator)
+    _remove(dest + SOURCE_SUFFIX)
+
+def fetch_if_modified(url, dest, etag = None):
+    # Downloads a small resource into dest unless the server says it still
+    # matches etag. Returns whether dest was written and the current ETag.
+    try:
+        response = _request('GET', url, {'If-None-Match' : etag} if etag else None)
+        if response.status == 304:
+            response.read()
+            return False, etag
+        if response.status != 200:
+            response.read()
+            raise TransferError('Error {0} {1} downloading "{2}"'.format(response.status, response.reason, url))
+        with open(dest, 'wb') as f:
+            _copy(response, f)
+    except httplib.HTTPException as e:
+        raise TransferError('Error downloading "{0}": {1!r}'.format(url, e))
+    length = response.getheader('Content-Length')
+    if length and os.path.getsize(dest) != int(length):
+        raise TransferError('Short download of "{0}"'.format(url))
+    return True, response.getheader('ETag')
@@ -0,0 +1,220 @@
+import os, mimetypes, multiprocessing, signal, tempfile, shutil, threading, subprocess
+from distutils.spawn import find_executable
+
+from cache import DerivativeCache, content_hash
+from metrics import metrics
+
+import pyexiv2
+import Image
+
+transforms = {
+        1 : (),
+        2 : (Image.FLIP_LEFT_RIGHT,),
+        3 : (Image.ROTATE_180,),
+        4 : (Image.FLIP_TOP_BOTTOM,),
+        5 : (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
+        6 : (Image.ROTATE_270,),
+        7 : (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
+        8 : (Image.ROTATE_90,)
+        }
+
+# jpegtran arguments that undo each EXIF orientation in the DCT domain
+lossless_transforms = {
+        1 : (),
+        2 : ('-flip', 'horizontal'),
+        3 : ('-rotate', '180'),
+        4 : ('-flip', 'vertical'),
+        5 : ('-transpose',),
+        6 : ('-rotate', '90'),
+        7 : ('-transverse',),
+        8 : ('-rotate', '270')
+        }
+
+jpegtran = find_executable('jpegtran')
+
+class TransformError(Exception): pass
+
+def _spool(mimetype, spool_dir):
+    fd, path = tempfile.mkstemp(prefix = 'picasasync-', suffix = mimetypes.guess_extension(mimetype) or '', dir = spool_dir)
+    os.close(fd)
+    return path
+
+def pil_transform(source, dest, orientation = 1, max_size = None):
+    image = Image.open(source)
+    if max_size:
+        image.thumbnail(max_size, Image.ANTIALIAS)
+    for t in transforms.get(orientation, ()):
+        image = image.transpose(t)
+    # TODO: save in the same format and size approx
+    image.save(dest, 'JPEG', quality = 95)
+
+def lossless_rotate(source, dest, orientation):
+    # Edge MCUs that cannot be moved losslessly are dropped (-trim), which
+    # crops at most 15 pixels from the right or bottom edge.
+    if not jpegtran:
+        return False
+    with open(dest, 'wb') as f:
+        return subprocess.call([jpegtran, '-copy', 'none', '-trim', '-optimize'] + list(lossless_transforms.get(orientation, ())) + [source], stdout = f) == 0
+
+def strip(path, mimetype, spool_dir):
+    spooled = _spool(mimetype, spool_dir)
+    try:
+        shutil.copyfile(path, spooled)
+        stripped = pyexiv2.ImageMetadata(spooled)
+        stripped.read()
+        for k in stripped.exif_keys + stripped.iptc_keys + stripped.xmp_keys:
+            del stripped[k]
+        del stripped.comment
+        stripped.write()
+    except Exception:
+        os.remove(spooled)
+        raise
+    return spooled, mimetype
+
+def transform(path, transform_list, max_size, strip_exif, raw, standard_types, spool_dir = None):
+    # Runs in a worker process. The result is handed back as the path of a
+    # temporary file, so the encoded photo never goes through the pipe and
+    # is never held in memory as a whole.
+    mimetype = mimetypes.guess_type(path)[0]
+    if not transform_list:
+        return strip(path, mimetype, spool_dir)
+
+    transform_list = transform_list[:]
+    original = pyexiv2.ImageMetadata(path)
+    try:
+        original.read()
+    except Exception as e:
+        raise TransformError(u'Error reading file "{0}": '.format(path) + str(e))
+
+    if 'raw' in transform_list and not raw:
+        transform_list.remove('raw')
+    if 'resize' in transform_list and not (original.dimensions[0] > max_size[0] or original.dimensions[1] > max_size[1]):
+        transform_list.remove('resize')
+    if 'rotate' in transform_list and ('Exif.Image.Orientation' not in original or original['Exif.Image.Orientation'].value == 1):
+        transform_list.remove('rotate')
+    if not transform_list:
+        return strip(path, mimetype, spool_dir) if strip_exif else (None, mimetype)
+
+    source = path
+    preview_path = None
+    if 'raw' in transform_list:
+        if len(original.previews) == 0:
+            raise TransformError(u'Error getting valid preview from raw file "{0}"'.format(path))
+        try:
+            preview = next(x for x in original.previews if (x.dimensions[0] >= max_size[0] or x.dimensions[1] >= max_size[1]) and x.mime_type in standard_types)
+        except StopIteration:
+            preview = original.previews[-1]
+        mimetype = preview.mime_type
+        if mimetype not in standard_types:
+            raise TransformError(u'Error getting valid preview from raw file "{0}"'.format(path))
+        preview_path = _spool(mimetype, spool_dir)
+        with open(preview_path, 'wb') as f:
+            f.write(preview.data)
+        source = preview_path
+    spooled = source
+    try:
+        if 'resize' in transform_list or 'rotate' in transform_list:
+            orientation = 1
+            if 'rotate' in transform_list:
+                orientation = original['Exif.Image.Orientation'].value
+                original['Exif.Image.Orientation'] = 1
+            spooled = _spool('image/jpeg', spool_dir)
+            if 'resize' in transform_list or mimetype != 'image/jpeg' or not lossless_rotate(source, spooled, orientation):
+                pil_transform(source, spooled, orientation, max_size if 'resize' in transform_list else None)
+            mimetype = 'image/jpeg'
+        if not strip_exif:
+            modified = pyexiv2.ImageMetadata(spooled)
+            modified.read()
+            original.copy(modified)
+            modified.write()
+    except Exception:
+        if spooled != path:
+            os.remove(spooled)
+        raise
+    finally:
+        if preview_path and preview_path != spooled:
+            os.remove(preview_path)
+    return spooled, mimetype
+
+def _transform(args):
+    try:
+        return transform(*args)
+    except TransformError:
+        raise
+    except Exception as e:
+        raise TransformError(u'Error transforming file "{0}": '.format(args[0]) + str(e))
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class MemoryBudget(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        if not self.limit:
+            return 0
+        # A body bigger than the whole budget is let through on its own
+        size = min(size, self.limit)
+        with self.cond:
+            while self.used and self.used + size > self.limit:
+                self.cond.wait(1)
+            self.used += size
+        return size
+
+    def release(self, size):
+        if not size:
+            return
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+class Transformer(object):
+    VERSION = 1
+
+    def __init__(self, cl_args, standard_types, processes = None):
+        self.transform_list = cl_args.transform
+        self.max_size = cl_args.max_size
+        self.strip_exif = cl_args.strip_exif
+        self.spool_dir = cl_args.spool_dir
+        self.standard_types = standard_types
+        self.budget = MemoryBudget(cl_args.max_memory and cl_args.max_memory * 1024 * 1024)
+        self.cache = None
+        if cl_args.cache_dir:
+            self.cache = DerivativeCache(cl_args.cache_dir, cl_args.cache_size * 1024 * 1024)
+        self.pool = multiprocessing.Pool(processes, _init_worker)
+
+    def params(self, raw):
+        return (self.VERSION, sorted(self.transform_list or ()), tuple(self.max_size), self.strip_exif, raw, bool(jpegtran))
+
+    def __call__(self, path, raw, digest = None):
+        try:
+            size = os.path.getsize(path)
+            key = self.cache and self.cache.key(digest or content_hash(path), self.params(raw))
+        except EnvironmentError as e:
+            raise TransformError(u'Error reading file "{0}": '.format(path) + str(e))
+        if key:
+            cached = self.cache.get(key)
+            if cached:
+                return cached[0], cached[1] or mimetypes.guess_type(path)[0]
+        reserved = self.budget.acquire(size)
+        try:
+            with metrics.phase('transform'):
+                spooled, mimetype = self.pool.apply(_transform, ((path, self.transform_list, self.max_size, self.strip_exif, raw, self.standard_types, self.spool_dir),))
+        finally:
+            self.budget.release(reserved)
+        if key:
+            spooled = self.cache.put(key, spooled, mimetype)
+        return spooled, mimetype
+
+    def release(self, spooled):
+        if self.cache and self.cache.contains(spooled):
+            self.cache.release(spooled)
+        else:
+            os.remove(spooled)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+
+# Measure the overhead the dryrun decorator adds to every photo action.
+# To compare with another version of the decorator, pass its directory:
+#
+#   python bench/bench_dryrun.py [-n CALLS]
+#   git show REV:PicasaSync/dryrun.py > /tmp/old/dryrun.py
+#   python bench/bench_dryrun.py --module /tmp/old
+
+import sys, os, argparse, time, logging
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PicasaSync'))
+
+LOG = logging.getLogger('bench')
+
+class Args(object):
+    dry_run = False
+
+def make_photo(dryrun):
+    class Photo(object):
+        def __init__(self):
+            self.args = Args()
+            self.title = 'IMG_0001'
+
+        @dryrun('self.args.dry_run', LOG, u'Uploading photo "{self.title}"{reason}')
+        def upload(self):
+            pass
+
+        def plain(self):
+            pass
+    return Photo
+
+def run(name, func, calls):
+    start = time.time()
+    for i in xrange(calls):
+        func()
+    elapsed = time.time() - start
+    print '{0:28s} {1:8.2f} us/call'.format(name, elapsed / calls * 1e6)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the dryrun decorator.')
+    parser.add_argument('-n', '--calls', type = int, default = 100000)
+    parser.add_argument('--module', metavar = 'DIR', help = 'Directory holding the dryrun.py to measure instead')
+    args = parser.parse_args()
+
+    if args.module:
+        sys.path.insert(0, args.module)
+    from dryrun import dryrun
+    logging.basicConfig(level = logging.WARNING)
+
+    photos = [make_photo(dryrun)() for i in xrange(args.calls)]
+    it = iter(photos)
+    run('undecorated', lambda: next(it).plain(), args.calls)
+    it = iter(photos)
+    run('first call on each photo', lambda: next(it).upload(reason = ' because'), args.calls)
+    photo = photos[0]
+    run('same photo', lambda: photo.upload(reason = ' because'), args.calls)
+    LOG.setLevel(logging.INFO)
+    LOG.addHandler(logging.NullHandler())
+    LOG.propagate = False
+    run('same photo, message logged', lambda: photo.upload(reason = ' because'), args.calls)
+    print 'attributes left on the photo: {0}'.format(sorted(set(vars(photo)) - set(['args', 'title'])))
+
+if __name__ == '__main__':
+    main()
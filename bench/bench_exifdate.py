@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+
+# Compare the header-only EXIF date reader used by the "exif" origin with
+# reading the whole metadata through pyexiv2.
+#
+#   python bench/bench_exifdate.py [-n RUNS] FILE...
+
+import sys, os, argparse, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PicasaSync'))
+
+import exifdate
+import pyexiv2
+
+def header(path):
+    with open(path, 'rb') as f:
+        try:
+            return exifdate.read_datetime(f)[1]
+        except exifdate.UnsupportedLayout:
+            return None
+
+def full(path):
+    metadata = pyexiv2.ImageMetadata(path)
+    try:
+        metadata.read()
+        if 'Exif.Image.DateTime' in metadata:
+            metadata['Exif.Image.DateTime'].value
+    except Exception:
+        pass
+    # exiv2 maps and parses the whole file
+    return os.path.getsize(path)
+
+def run(name, func, paths, runs):
+    start = time.time()
+    for i in xrange(runs):
+        read = [func(path) for path in paths]
+    elapsed = (time.time() - start) / runs / len(paths)
+    fallbacks = read.count(None)
+    read = [r for r in read if r is not None]
+    print '{0:10s} {1:8.3f} ms/file {2:12.0f} bytes/file  pyexiv2 fallbacks: {3}'.format(name, elapsed * 1000, float(sum(read)) / len(read) if read else 0, fallbacks)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark reading the EXIF timestamp of photos.')
+    parser.add_argument('-n', '--runs', type = int, default = 3)
+    parser.add_argument('paths', metavar = 'FILE', nargs = '+')
+    args = parser.parse_args()
+
+    run('header', header, args.paths, args.runs)
+    run('pyexiv2', full, args.paths, args.runs)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+
+# Check the filename date recognizers used by the "filename" origin against
+# plain dateutil on a corpus of names, and time both.
+#
+#   python bench/bench_filedate.py [-n RUNS] [PATH...]
+#
+# The corpus is a set of common camera and phone names plus the files and
+# directories under every PATH given.
+
+import sys, os, argparse, time, warnings
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PicasaSync'))
+
+import filedate
+
+corpus = [
+        'IMG_20120304_101112.jpg', 'IMG_20121304_101112.jpg', 'IMG_20120325_101112.JPG', 'IMG_20121313_101112.jpg',
+        'VID_20120304_101112.jpg', 'PXL_20210304_101112345.jpg', 'IMG_20120304_101112_1.jpg', 'IMG_20120304.jpg',
+        'DSC_20120304101112.JPG', 'DSC01234.JPG', 'DSCN1234.jpg', 'DSC_1234.JPG', 'DSCF1234.JPG', 'IMG_1234.jpg',
+        'P1010001.JPG', 'P1020345.JPG', '_MG_1234.jpg', 'Photos/2012-03-04/DSC_1234.JPG', 'IMG_123.jpg', 'Party 3',
+        '20120304_101112.jpg', '20120304.png', '20120304101112.nef', '2012-03-04.jpg', '2012-13-04.jpg',
+        '2012-03-04T10:11:12.jpg', '2012-03-04 10.11.12.jpg', '2012-03-04_10-11-12.jpg', '04-03-2012.jpg',
+        '2012_03_04', 'Photos/2012/2012-03-04 Trip', 'Photos/Summer 2012', 'Photos/2012-03-04', 'Holidays',
+        ]
+
+def names(paths):
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            yield root
+            for f in files:
+                yield f
+
+def dateutil_only(text):
+    value = filedate._parse(text)
+    return filedate.calendar.timegm(value.timetuple()) if value else None
+
+def run(name, func, corpus, runs):
+    start = time.time()
+    for i in xrange(runs):
+        results = [func(text) for text in corpus]
+    elapsed = (time.time() - start) / runs / len(corpus)
+    print '{0:10s} {1:8.3f} ms/name'.format(name, elapsed * 1000)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark and check filename date parsing.')
+    parser.add_argument('-n', '--runs', type = int, default = 3)
+    parser.add_argument('paths', metavar = 'PATH', nargs = '*')
+    args = parser.parse_args()
+
+    names_ = corpus + list(names(args.paths))
+    warnings.simplefilter('ignore')
+    fast = run('filedate', filedate.timestamp, names_, args.runs)
+    slow = run('dateutil', dateutil_only, names_, args.runs)
+    parsed = []
+    parse = filedate._parse
+    filedate._parse = lambda text: parsed.append(text) or parse(text)
+    for text in names_:
+        filedate.timestamp(text)
+    filedate._parse = parse
+    print '{0} names, {1} resolved without dateutil'.format(len(names_), len(names_) - len(parsed))
+    mismatches = []
+    for text, f, s in zip(names_, fast, slow):
+        if f == s:
+            continue
+        if f is None and text not in parsed:
+            # A counter or too few digits, dateutil makes up a date
+            print 'NO DATE  {0!r}: dateutil says {1}'.format(text, s)
+        else:
+            mismatches.append((text, f, s))
+    for text, f, s in mismatches:
+        print 'MISMATCH {0!r}: {1} != {2}'.format(text, f, s)
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+    main()
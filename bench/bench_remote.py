@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+# Compare the memory taken by the remote photos of an account when the full
+# GData entries are kept, as before, and when only the compact records are.
+# Every mode runs in a fresh process, which parses photo feeds shaped like
+# the Picasa ones page by page and keeps what the sync would keep.
+#
+#   python bench/bench_remote.py [-n PHOTOS]
+
+import sys, os, time, argparse, resource, subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PicasaSync'))
+
+PAGE_SIZE = 1000
+ENTRY = '''<entry gd:etag='"YD0qeyI."'>
+<id>https://picasaweb.google.com/data/entry/api/user/default/albumid/{album}/photoid/{id}</id>
+<published>2012-03-04T10:11:12.000Z</published><updated>2012-03-04T10:11:12.000Z</updated>
+<category scheme='http://schemas.google.com/g/2005#kind' term='http://schemas.google.com/photos/2007#photo'/>
+<title type='text'>IMG_{id}.jpg</title><summary type='text'></summary>
+<content type='image/jpeg' src='https://lh3.googleusercontent.com/-abcdefghijk/AAAAAAAAAAI/AAAAAAAAAAA/{id}/IMG_{id}.jpg'/>
+<link rel='http://schemas.google.com/g/2005#feed' type='application/atom+xml' href='https://picasaweb.google.com/data/feed/api/user/default/albumid/{album}/photoid/{id}'/>
+<link rel='alternate' type='text/html' href='https://picasaweb.google.com/user/Album#{id}'/>
+<link rel='self' type='application/atom+xml' href='https://picasaweb.google.com/data/entry/api/user/default/albumid/{album}/photoid/{id}'/>
+<link rel='edit' type='application/atom+xml' href='https://picasaweb.google.com/data/entry/api/user/default/albumid/{album}/photoid/{id}/1'/>
+<link rel='edit-media' type='image/jpeg' href='https://picasaweb.google.com/data/media/api/user/default/albumid/{album}/photoid/{id}/1'/>
+<gphoto:id>{id}</gphoto:id><gphoto:version>1</gphoto:version><gphoto:position>{id}</gphoto:position><gphoto:albumid>{album}</gphoto:albumid>
+<gphoto:access>public</gphoto:access><gphoto:width>4000</gphoto:width><gphoto:height>3000</gphoto:height><gphoto:size>4123456</gphoto:size>
+<gphoto:client/><gphoto:checksum/><gphoto:timestamp>1330855872000</gphoto:timestamp><gphoto:imageVersion>1</gphoto:imageVersion>
+<gphoto:commentingEnabled>true</gphoto:commentingEnabled><gphoto:commentCount>0</gphoto:commentCount><gphoto:license id='0' name='All Rights Reserved' url=''>ALL_RIGHTS_RESERVED</gphoto:license>
+<exif:tags><exif:fstop>2.8</exif:fstop><exif:make>NIKON</exif:make><exif:model>D90</exif:model><exif:exposure>0.01</exif:exposure><exif:flash>false</exif:flash><exif:focallength>35.0</exif:focallength><exif:iso>200</exif:iso><exif:time>1330855872000</exif:time><exif:imageUniqueID>{id}</exif:imageUniqueID></exif:tags>
+<media:group><media:content url='https://lh3.googleusercontent.com/-abcdefghijk/AAAAAAAAAAI/AAAAAAAAAAA/{id}/IMG_{id}.jpg' height='1200' width='1600' type='image/jpeg' medium='image'/>
+<media:credit>User</media:credit><media:description type='plain'></media:description><media:keywords/>
+<media:thumbnail url='https://lh3.googleusercontent.com/-abcdefghijk/AAAAAAAAAAI/AAAAAAAAAAA/{id}/s72/IMG_{id}.jpg' height='54' width='72'/>
+<media:thumbnail url='https://lh3.googleusercontent.com/-abcdefghijk/AAAAAAAAAAI/AAAAAAAAAAA/{id}/s144/IMG_{id}.jpg' height='108' width='144'/>
+<media:thumbnail url='https://lh3.googleusercontent.com/-abcdefghijk/AAAAAAAAAAI/AAAAAAAAAAA/{id}/s288/IMG_{id}.jpg' height='216' width='288'/>
+<media:title type='plain'>IMG_{id}.jpg</media:title></media:group>
+</entry>'''
+FEED = '''<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns='http://www.w3.org/2005/Atom' xmlns:exif='http://schemas.google.com/photos/exif/2007' xmlns:gphoto='http://schemas.google.com/photos/2007' xmlns:media='http://search.yahoo.com/mrss/' xmlns:gd='http://schemas.google.com/g/2005'>
+<id>https://picasaweb.google.com/data/feed/api/user/default/albumid/{album}</id>
+<category scheme='http://schemas.google.com/g/2005#kind' term='http://schemas.google.com/photos/2007#album'/>
+<title type='text'>Album</title>
+{entries}
+</feed>'''
+
+def peak():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def size(obj, seen):
+    # Bytes taken by obj and everything only reachable through it, as the
+    # process RSS does not shrink when the parsed pages are freed
+    if id(obj) in seen or obj is None or isinstance(obj, (bool, type)):
+        return 0
+    seen.add(id(obj))
+    total = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        total += sum(size(k, seen) + size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        total += sum(size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        total += size(vars(obj), seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        total += size(getattr(obj, name, None), seen)
+    return total
+
+def child(mode, photos):
+    import gdata.photos
+    from remote import RemotePhoto
+    kept = []
+    baseline = peak()
+    start = time.time()
+    for page in xrange(0, photos, PAGE_SIZE):
+        album = 5000000000000000000 + page / PAGE_SIZE
+        xml = FEED.format(album = album, entries = '\n'.join(ENTRY.format(album = album, id = 6000000000000000000 + i) for i in xrange(page, min(photos, page + PAGE_SIZE))))
+        feed = gdata.photos.PhotoFeedFromString(xml)
+        if mode == 'entries':
+            kept.extend(feed.entry)
+        else:
+            kept.extend(RemotePhoto.from_entry(entry) for entry in feed.entry)
+        del feed, xml
+    elapsed = time.time() - start
+    grown = peak() - baseline
+    retained = size(kept, set()) / 1048576.0
+    print '{0:10s} {1:8d} photos  peak RSS +{2:7.1f} MB  kept {3:7.1f} MB ({4:5.2f} KB/photo)  {5:6.1f}s'.format(mode, len(kept), grown, retained, retained * 1024 / photos, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the memory taken by remote photo records.')
+    parser.add_argument('-n', '--photos', type = int, default = 20000)
+    parser.add_argument('--mode', choices = ('entries', 'records'), help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        return child(args.mode, args.photos)
+    for mode in ('entries', 'records'):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '-n', str(args.photos), '--mode', mode])
+
+if __name__ == '__main__':
+    main()
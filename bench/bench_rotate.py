@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+
+# Compare the lossless jpegtran rotation used by --transform rotate with the
+# PIL decode/transpose/encode fallback.
+#
+#   python bench/bench_rotate.py [-n RUNS] [-o ORIENTATION] [JPEG]
+
+import sys, os, argparse, tempfile, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PicasaSync import transform
+import Image
+
+# Applying the same orientation again gives back the original for these
+inverse = {2 : 2, 3 : 3, 4 : 4, 5 : 5, 6 : 8, 7 : 7, 8 : 6}
+
+def synthetic(path, size):
+    image = Image.new('RGB', size)
+    image.putdata([(random.randint(0, 255), x % 256, y % 256) for y in xrange(size[1]) for x in xrange(size[0])])
+    image.save(path, 'JPEG', quality = 92)
+
+def run(name, func, source, orientation, runs):
+    dest = tempfile.mktemp(suffix = '.jpg')
+    back = tempfile.mktemp(suffix = '.jpg')
+    start = time.time()
+    for i in xrange(runs):
+        if func(source, dest, orientation) is False:
+            print '{0:10s} not available'.format(name)
+            return
+    elapsed = (time.time() - start) / runs
+    func(dest, back, inverse[orientation])
+    identical = list(Image.open(source).getdata()) == list(Image.open(back).getdata())
+    print '{0:10s} {1:8.1f} ms/photo {2:10d} bytes  lossless: {3}'.format(name, elapsed * 1000, os.path.getsize(dest), 'yes' if identical else 'no')
+    os.remove(dest)
+    os.remove(back)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark lossless against re-encoding JPEG rotation.')
+    parser.add_argument('-n', '--runs', type = int, default = 10)
+    parser.add_argument('-o', '--orientation', type = int, default = 6, choices = sorted(inverse))
+    parser.add_argument('path', nargs = '?', help = 'JPEG to rotate. A 1600x1200 synthetic photo is used if not given.')
+    args = parser.parse_args()
+
+    path = args.path
+    if not path:
+        path = tempfile.mktemp(suffix = '.jpg')
+        synthetic(path, (1600, 1200))
+    try:
+        run('pil', lambda s, d, o: transform.pil_transform(s, d, o), path, args.orientation, args.runs)
+        run('jpegtran', transform.lossless_rotate, path, args.orientation, args.runs)
+    finally:
+        if not args.path:
+            os.remove(path)
+
+if __name__ == '__main__':
+    main()
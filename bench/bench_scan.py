@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+# Compare the threaded scandir scanner used to fill the local albums with a
+# plain os.walk, guess_type and stat loop over the same tree.
+#
+#   python bench/bench_scan.py [-t THREADS] PATH
+
+import sys, os, argparse, mimetypes, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PicasaSync'))
+
+import scanner
+
+types = set(['image/jpeg', 'image/x-ms-bmp', 'image/gif', 'image/png', 'image/x-nikon-nef'])
+
+def walk(path):
+    count = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            if mimetypes.guess_type(f)[0] in types:
+                os.stat(os.path.join(root, f))
+                count += 1
+    return count
+
+def scan(path, threads):
+    directories = scanner.DiskScanner(types, threads).scan(path, lambda root, name, st: st)
+    return sum(len(files) for files in directories.itervalues())
+
+def run(name, func):
+    start = time.time()
+    count = func()
+    elapsed = time.time() - start
+    print '{0:14s} {1:8d} files {2:8.2f} s {3:10.0f} files/s'.format(name, count, elapsed, count / elapsed if elapsed else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark local photo tree scanning.')
+    parser.add_argument('-t', '--threads', type = int, default = 8)
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    print 'scandir module: {0}'.format('yes' if scanner.scandir else 'no')
+    run('os.walk', lambda: walk(args.path))
+    run('scanner x1', lambda: scan(args.path, 1))
+    run('scanner x{0}'.format(args.threads), lambda: scan(args.path, args.threads))
+
+if __name__ == '__main__':
+    main()
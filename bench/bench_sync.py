@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+# Run a whole sync against a local fake Picasa server and report where the
+# time went, so different versions and settings can be compared offline.
+#
+#   python bench/gentree.py -a 20 -p 50 /tmp/tree
+#   python bench/bench_sync.py [--latency MS] [--bandwidth KB] [--json] \
+#       [--error-rate P] [--error-status STATUS] [--max-inflight N] \
+#       [--page-size N] [--drop-after BYTES] \
+#       /tmp/tree -- -u -t 4 --transform rotate --no-index
+#
+# Everything after -- is passed to picasasync as is. The photo tree is
+# uploaded to an empty server, unless --seed-remote is given, in which case
+# the server starts with the albums under that directory.
+
+import sys, os, time, json, argparse, tempfile, resource
+
+import common
+import throttle
+from metrics import metrics
+
+def start_server(args):
+    options = ['--latency', str(args.latency), '--bandwidth', str(args.bandwidth), '--error-rate', str(args.error_rate),
+            '--error-status', str(args.error_status), '--max-inflight', str(args.max_inflight),
+            '--page-size', str(args.page_size)]
+    if args.drop_after:
+        options += ['--drop-after', str(args.drop_after)]
+    if args.seed_remote:
+        options += ['--seed', args.seed_remote]
+    return common.start_server(options)
+
+def main():
+    argv = sys.argv[1:]
+    options = []
+    if '--' in argv:
+        options = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parser = argparse.ArgumentParser(description = 'Benchmark a sync against a fake Picasa server.')
+    parser.add_argument('--latency', type = float, default = 0, metavar = 'MS')
+    parser.add_argument('--bandwidth', type = float, default = 0, metavar = 'KB')
+    parser.add_argument('--error-rate', type = float, default = 0, metavar = 'P')
+    parser.add_argument('--error-status', type = int, default = 500, metavar = 'STATUS')
+    parser.add_argument('--max-inflight', type = int, default = 0, metavar = 'N')
+    parser.add_argument('--page-size', type = int, default = 0, metavar = 'N', help = 'Maximum number of entries in a feed page')
+    parser.add_argument('--drop-after', type = int, metavar = 'BYTES', help = 'Close every media download after BYTES')
+    parser.add_argument('--base-delay', type = float, metavar = 'S', help = 'First backoff delay after a throttled request')
+    parser.add_argument('--seed-remote', metavar = 'DIR', help = 'Start the server with the albums under DIR')
+    parser.add_argument('--json', action = 'store_true', help = 'Print the report as JSON')
+    parser.add_argument('path', metavar = 'PATH')
+    args = parser.parse_args(argv)
+
+    server, host = start_server(args)
+    workdir = tempfile.mkdtemp(prefix = 'picasasync-bench-')
+    cwd = os.getcwd()
+    try:
+        # data.json and downloaded thumbnails go to the current directory
+        os.chdir(workdir)
+        app = common.app(host, options + [os.path.join(cwd, args.path)])
+        if args.base_delay is not None:
+            throttle.Throttle.BASE_DELAY = args.base_delay
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        app.sync()
+        elapsed = time.time() - start
+        stats = common.stats(host)
+        phases = metrics.summary()['phases']
+    finally:
+        os.chdir(cwd)
+        common.stop_server(server)
+
+    report = {
+            'options' : options,
+            'total_s' : elapsed,
+            'scan_s' : phases.get('scan', {}).get('wall_seconds', 0),
+            'feeds_s' : phases.get('feed', {}).get('seconds', 0),
+            'feeds_wall_s' : phases.get('feed', {}).get('wall_seconds', 0),
+            'upload_mb_s' : stats.get('media_in', 0) / elapsed / 1048576,
+            'download_mb_s' : stats.get('media_out', 0) / elapsed / 1048576,
+            'requests' : stats.get('requests', 0),
+            'errors' : stats.get('errors', 0),
+            'throttled' : stats.get('throttled', 0),
+            'uploads' : stats.get('uploads', 0) + stats.get('blob_updates', 0),
+            'downloads' : stats.get('downloads', 0),
+            'metadata_updates' : stats.get('metadata_updates', 0),
+            'batches' : stats.get('batches', 0),
+            'peak_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'baseline_rss_mb' : rss / 1024.0,
+            'children_peak_rss_mb' : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+            }
+    if args.json:
+        print json.dumps(report, sort_keys = True)
+        return
+    print 'picasasync {0}'.format(' '.join(options))
+    print '  total          {total_s:10.2f} s'.format(**report)
+    print '  scan           {scan_s:10.2f} s'.format(**report)
+    print '  feeds          {feeds_s:10.2f} s (summed over threads, {feeds_wall_s:.2f} s wall)'.format(**report)
+    print '  upload         {upload_mb_s:10.2f} MB/s ({uploads} photos)'.format(**report)
+    print '  download       {download_mb_s:10.2f} MB/s ({downloads} photos)'.format(**report)
+    print '  metadata       {metadata_updates:10d} photos ({batches} batches)'.format(**report)
+    print '  requests       {requests:10d} ({errors} failed, {throttled} over --max-inflight)'.format(**report)
+    print '  peak RSS       {peak_rss_mb:10.1f} MB (baseline {baseline_rss_mb:.1f} MB, children {children_peak_rss_mb:.1f} MB)'.format(**report)
+
+if __name__ == '__main__':
+    main()
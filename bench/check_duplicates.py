@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+
+# Check that two Picasa albums with the same title do not abort a sync.
+# The fake server gets two albums "Trip" next to a local "Trip" and a
+# local "Other". The sync has to log the duplicate, still upload "Other"
+# and not record "Trip" as synced. Runs with and without --pipeline.
+#
+#   python bench/check_duplicates.py
+
+import sys, os, shutil, sqlite3, tempfile
+
+import common
+from metrics import metrics
+
+MODES = [['-u', '-t', '1'], ['-u', '-t', '4'], ['-u', '-t', '4', '--pipeline']]
+
+def check(options):
+    workdir = tempfile.mkdtemp(prefix = 'picasasync-duplicates-')
+    for title in ('Trip', 'Other'):
+        os.makedirs(os.path.join(workdir, 'tree', title))
+        with open(os.path.join(workdir, 'tree', title, 'IMG_0000.jpg'), 'wb') as f:
+            f.write(os.urandom(4096))
+    server, host = common.start_server()
+    cwd = os.getcwd()
+    index = os.path.join(workdir, 'index.db')
+    errors = metrics.summary()['errors'].get('InvalidArguments', 0)
+    try:
+        client = common.client(host)
+        for i in xrange(2):
+            client.InsertAlbum(title = 'Trip', summary = None, access = 'public')
+        # data.json goes to the current directory
+        os.chdir(workdir)
+        try:
+            common.app(host, options + ['--skip-unchanged', '--index', index, os.path.join(workdir, 'tree')]).sync()
+        except Exception as e:
+            print '{0:24s} FAILED: {1!r}'.format(' '.join(options), e)
+            return False
+        uploads = common.stats(host).get('uploads', 0)
+        recorded = [title for title, in sqlite3.connect(index).execute('SELECT title FROM albums')]
+    finally:
+        os.chdir(cwd)
+        common.stop_server(server)
+        shutil.rmtree(workdir)
+    errors = metrics.summary()['errors'].get('InvalidArguments', 0) - errors
+    ok = uploads == 2 and errors == 1 and 'Trip' not in recorded
+    print '{0:24s} {1}: {2} uploads, {3} duplicate logged, recorded as synced: {4}'.format(' '.join(options), 'ok' if ok else 'FAILED', uploads, errors, ', '.join(recorded) or 'none')
+    return ok
+
+def main():
+    results = [check(options) for options in MODES]
+    if not all(results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+
+# Check that transfer.fetch resumes downloads cut off partway through,
+# against the fake server closing every media response after a few bytes.
+# Partial data of another version of the photo has to be thrown away.
+# Exits with an error if a download comes out wrong, or if any byte had to
+# be sent twice or partial data was reused when it should not be.
+#
+#   python bench/check_fetch.py [--size BYTES] [--drop-after BYTES]
+
+import sys, os, re, shutil, urllib, httplib, urlparse, argparse, tempfile
+
+import common
+import transfer
+
+def media_url(host):
+    albums = urllib.urlopen('http://%s/data/feed/api/user/default' % host).read()
+    album_id = re.search(r'<(?:\w+:)?id>(\d+)</', albums.split('entry', 1)[1]).group(1)
+    photos = urllib.urlopen('http://%s/data/feed/api/user/default/albumid/%s' % (host, album_id)).read()
+    return re.search(r'src="([^"]*/media/[^"]*)"', photos).group(1)
+
+def media_etag(url):
+    parts = urlparse.urlsplit(url)
+    connection = httplib.HTTPConnection(parts.netloc)
+    connection.request('HEAD', parts.path)
+    return connection.getresponse().getheader('ETag')
+
+def media_out(host):
+    return common.stats(host).get('media_out', 0)
+
+def partial(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def source(dest, url, etag):
+    # What transfer.fetch leaves next to partial data
+    with open(dest + transfer.SOURCE_SUFFIX, 'w') as f:
+        f.write('{0}\n{1}'.format(url, etag))
+
+def check(name, host, url, dest, data, fetch, reused = 0):
+    before = media_out(host)
+    fetch(url, dest)
+    with open(dest, 'rb') as f:
+        got = f.read()
+    sent = media_out(host) - before
+    ok = got == data and sent == len(data) - reused
+    print '{0:24s} {1}: {2} bytes, {3} sent by the server'.format(name, 'ok' if ok else 'FAILED', len(got), sent)
+    os.remove(dest)
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Check resumed downloads against a fake server that drops connections.')
+    parser.add_argument('--size', type = int, default = 1200 * 1024, metavar = 'BYTES')
+    parser.add_argument('--drop-after', type = int, default = 100 * 1024, metavar = 'BYTES')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = 'picasasync-fetch-')
+    seed = os.path.join(workdir, 'seed', 'album')
+    os.makedirs(seed)
+    data = os.urandom(args.size)
+    with open(os.path.join(seed, 'photo.jpg'), 'wb') as f:
+        f.write(data)
+    # Every response brings at most --drop-after bytes
+    transfer.RETRIES = args.size / args.drop_after + 2
+    transfer.PARALLEL_MIN_SIZE = 0
+    server, host = common.start_server(['--seed', os.path.join(workdir, 'seed'), '--drop-after', str(args.drop_after)])
+    try:
+        url = media_url(host)
+        etag = media_etag(url)
+        dest = os.path.join(workdir, 'photo.jpg.part')
+        split = lambda url, dest: transfer.fetch(url, dest, 4)
+        results = [check('single range', host, url, dest, data, transfer.fetch)]
+        third = args.size / 3
+        partial(dest, data[:third])
+        source(dest, url, etag)
+        results.append(check('resumed from .part', host, url, dest, data, transfer.fetch, third))
+        # Partial data of another version, or of an unknown one
+        partial(dest, os.urandom(third))
+        source(dest, url, '"older"')
+        results.append(check('.part of older version', host, url, dest, data, transfer.fetch))
+        partial(dest, data[:third])
+        results.append(check('.part of unknown source', host, url, dest, data, transfer.fetch))
+        results.append(check('4 segments', host, url, dest, data, split))
+        # Pieces left by a download split in two, and a first piece that
+        # holds more than its range
+        half = (args.size + 1) / 2
+        quarter = (args.size + 3) / 4
+        partial('{0}.0-{1}'.format(dest, half - 1), data[:half])
+        partial('{0}.0-{1}'.format(dest, quarter - 1), data[:half])
+        source(dest, url, etag)
+        results.append(check('stale pieces', host, url, dest, data, split))
+        partial('{0}.0-{1}'.format(dest, quarter - 1), os.urandom(quarter))
+        source(dest, url, '"older"')
+        results.append(check('pieces of older version', host, url, dest, data, split))
+        leftover = [f for f in os.listdir(workdir) if f.startswith('photo.jpg')]
+        if leftover:
+            print 'FAILED: left behind {0}'.format(', '.join(leftover))
+            results.append(False)
+    finally:
+        common.stop_server(server)
+        shutil.rmtree(workdir)
+    if not all(results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
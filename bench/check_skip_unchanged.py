@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+
+# Check that --skip-unchanged skips an album that did not change, when the
+# album is the first PATH and also holds the index. The album is synced
+# twice against a fake server seeded with it, the second sync has to skip it.
+#
+#   python bench/check_skip_unchanged.py [-p PHOTOS]
+
+import sys, os, shutil, argparse, tempfile
+
+import common
+from metrics import metrics
+
+def sync(host, options):
+    before = metrics.summary()['counters'].get('albums_skipped', 0)
+    requests = common.stats(host).get('requests', 0)
+    common.app(host, options).sync()
+    return metrics.summary()['counters'].get('albums_skipped', 0) - before, common.stats(host).get('requests', 0) - requests
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Check that an unchanged album given as the first PATH is skipped.')
+    parser.add_argument('-p', '--photos', type = int, default = 5, metavar = 'PHOTOS')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = 'picasasync-skip-')
+    album = os.path.join(workdir, 'seed', 'trip')
+    os.makedirs(album)
+    for i in xrange(args.photos):
+        with open(os.path.join(album, 'IMG_%04d.jpg' % i), 'wb') as f:
+            f.write(os.urandom(4096))
+    server, host = common.start_server(['--seed', os.path.join(workdir, 'seed')])
+    cwd = os.getcwd()
+    results = []
+    try:
+        # data.json goes to the current directory
+        os.chdir(workdir)
+        for run in xrange(2):
+            skipped, requests = sync(host, ['-u', '-d', '--skip-unchanged', '--index', os.path.join(album, '.picasasync.db'), album])
+            print 'sync {0}: {1} album skipped, {2} requests'.format(run + 1, skipped, requests)
+            results.append(skipped)
+    finally:
+        os.chdir(cwd)
+        common.stop_server(server)
+        shutil.rmtree(workdir)
+    if results != [0, 1]:
+        print 'FAILED: the album was not skipped on the second sync'
+        sys.exit(1)
+    print 'ok'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+# Check that a server throttling uploads loses no photos. The fake server
+# answers 429 to a fifth of the requests, before it has read the upload
+# body, so some uploads fail on a broken pipe or a reset connection
+# rather than the status. The sync has to retry them like the 429s and
+# upload every photo.
+#
+#   python bench/check_throttle.py
+
+import sys, os, shutil, tempfile
+
+import common
+from throttle import Throttle
+
+ALBUMS = 3
+PHOTOS = 30
+OPTIONS = ['-u', '-t', '4', '--no-index']
+
+def main():
+    workdir = tempfile.mkdtemp(prefix = 'picasasync-throttle-')
+    for a in xrange(ALBUMS):
+        os.makedirs(os.path.join(workdir, 'tree', 'album%03d' % a))
+        for p in xrange(PHOTOS):
+            with open(os.path.join(workdir, 'tree', 'album%03d' % a, 'IMG_%04d.jpg' % p), 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+    server, host = common.start_server(['--error-rate', '0.2', '--error-status', '429'])
+    cwd = os.getcwd()
+    # Keep the backoff short, the check is about what is retried
+    Throttle.BASE_DELAY = 0.05
+    try:
+        # data.json goes to the current directory
+        os.chdir(workdir)
+        common.app(host, OPTIONS + [os.path.join(workdir, 'tree')]).sync()
+        uploads = common.stats(host).get('uploads', 0)
+    finally:
+        os.chdir(cwd)
+        common.stop_server(server)
+        shutil.rmtree(workdir)
+    ok = uploads == ALBUMS * PHOTOS
+    print '{0:24s} {1}: {2} of {3} photos uploaded'.format(' '.join(OPTIONS), 'ok' if ok else 'FAILED', uploads, ALBUMS * PHOTOS)
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
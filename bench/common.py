@@ -0,0 +1,46 @@
+# Scaffolding shared by the benchmarks and checks that sync against the
+# fake Picasa server in bench/fakepicasa.py.
+
+import sys, os, json, urllib, subprocess, multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PicasaSync'))
+
+import googlecl.picasa.service as picasa_service
+import PicasaSync
+import transfer
+
+class Config(object):
+    # Stands in for the googlecl configuration, which needs a login
+    def lazy_get(self, section, option, default = None, option_type = None):
+        return {'access' : 'public'}.get(option, default)
+
+def client(host):
+    client = picasa_service.SERVICE_CLASS(Config())
+    client.server = host
+    client.email = 'default'
+    client.http_client = transfer.PooledHttpClient()
+    return client
+
+def start_server(options = ()):
+    # Returns the server process and the host:port it listens on
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakepicasa.py'), '-p', '0'] + list(options)
+    server = subprocess.Popen(command, stdout = subprocess.PIPE)
+    line = server.stdout.readline()
+    return server, line.strip().split('//')[1].rstrip('/')
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+def stats(host):
+    return json.loads(urllib.urlopen('http://%s/_stats' % host).read())
+
+def app(host, options):
+    # A PicasaSync set up from picasasync command line options, with
+    # clients of the fake server at host
+    sys.argv = ['picasasync'] + options
+    app = PicasaSync.PicasaSync.__new__(PicasaSync.PicasaSync)
+    app.ncores = multiprocessing.cpu_count()
+    app.parse_cl_args()
+    sys.stdout = sys.__stdout__
+    app.clients = [client(host) for i in xrange(app.cl_args.threads)]
+    return app
@@ -0,0 +1,471 @@
+#! /usr/bin/env python
+
+# A local stand-in for the Picasa Web Albums GData API, good enough to run
+# AlbumList.sync against: the album and photo feeds, album and photo entries,
+# InsertAlbum, InsertPhoto, UpdatePhotoBlob, UpdatePhotoMetadata, Delete,
+# batch metadata updates to an album's feed URL plus /batch, and media and
+# thumbnail downloads with range requests. Everything is kept in memory.
+#
+#   python bench/fakepicasa.py [-p PORT] [--latency MS] [--bandwidth KB]
+#                              [--error-rate P] [--error-status STATUS]
+#                              [--max-inflight N] [--page-size N] [--seed DIR]
+#                              [--drop-after BYTES]
+#
+# GET /_stats returns the request and byte counters as JSON.
+
+import sys, os, re, time, json, zlib, random, argparse, threading, mimetypes, urlparse, datetime
+from xml.etree import cElementTree as ElementTree
+import BaseHTTPServer, SocketServer
+
+import atom
+import gdata
+import gdata.photos
+import gdata.media
+
+CHUNK_SIZE = 64 * 1024
+FEED = 'http://schemas.google.com/g/2005#feed'
+ATOM = '{%s}' % atom.ATOM_NAMESPACE
+PHOTOS = '{%s}' % gdata.photos.PHOTOS_NAMESPACE
+BATCH = '{%s}' % gdata.BATCH_NAMESPACE
+
+class Photo(object):
+    def __init__(self, photo_id, album_id, title, timestamp, data, mimetype, checksum = None):
+        self.id = photo_id
+        self.album_id = album_id
+        self.title = title
+        self.timestamp = timestamp
+        self.data = data
+        self.mimetype = mimetype
+        self.checksum = checksum
+        self.version = 1
+
+def atom_time(t = None):
+    return (datetime.datetime.utcfromtimestamp(t) if t is not None else datetime.datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+class Album(object):
+    def __init__(self, album_id, title, timestamp, access = 'public'):
+        self.id = album_id
+        self.title = title
+        self.timestamp = timestamp
+        self.access = access
+        self.published = atom_time()
+        self.updated = self.published
+        self.photos = {}
+
+    def touch(self):
+        # Like Picasa, any change to the photos updates the album
+        self.updated = atom_time()
+
+class Store(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.albums = {}
+        self.next_id = 1000
+        self.stats = {}
+        self.inflight = 0
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return str(self.next_id)
+
+    def count(self, key, n = 1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def seed(self, root):
+        for path, dirs, files in os.walk(root):
+            files = sorted(f for f in files if (mimetypes.guess_type(f)[0] or '').startswith('image/'))
+            if not files:
+                continue
+            album = Album(self.new_id(), os.path.relpath(path, root) if path != root else os.path.basename(os.path.normpath(root)), int(os.stat(path).st_mtime) * 1000)
+            self.albums[album.id] = album
+            for f in files:
+                full_path = os.path.join(path, f)
+                with open(full_path, 'rb') as data:
+                    photo = Photo(self.new_id(), album.id, f, int(os.stat(full_path).st_mtime) * 1000, data.read(), mimetypes.guess_type(f)[0])
+                album.photos[photo.id] = photo
+            # From the files, so the seeded albums look the same to every run
+            album.updated = atom_time(max(os.stat(os.path.join(path, f)).st_mtime for f in files))
+
+store = Store()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    @property
+    def base(self):
+        return 'http://' + self.headers.get('Host', '%s:%s' % self.server.server_address)
+
+    def throttle(self, size, start):
+        if self.options.bandwidth:
+            delay = start + float(size) / (self.options.bandwidth * 1024) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        chunks = []
+        start = time.time()
+        read = 0
+        while read < length:
+            chunk = self.rfile.read(min(CHUNK_SIZE, length - read))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            read += len(chunk)
+            self.throttle(read, start)
+        store.count('bytes_in', read)
+        return ''.join(chunks)
+
+    def send(self, status, body = '', content_type = 'application/atom+xml', headers = None, drop_after = None):
+        # Returns how much of the body was sent, which is only up to
+        # drop_after bytes before the connection is closed
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).iteritems():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return 0
+        sent = len(body) if drop_after is None else min(len(body), drop_after)
+        start = time.time()
+        for i in xrange(0, sent, CHUNK_SIZE):
+            self.wfile.write(body[i:min(i + CHUNK_SIZE, sent)])
+            self.throttle(i + CHUNK_SIZE, start)
+        store.count('bytes_out', sent)
+        if sent < len(body):
+            # Like a connection lost partway through the response
+            store.count('dropped')
+            self.close_connection = 1
+        return sent
+
+    def fail(self, status, reason):
+        store.count('errors')
+        self.close_connection = 1
+        self.send(status, reason, 'text/plain', {'Connection' : 'close'})
+
+    def album_entry(self, album):
+        entry = gdata.photos.AlbumEntry(
+                title = atom.Title(text = album.title),
+                gphoto_id = gdata.photos.Id(text = album.id),
+                access = gdata.photos.Access(text = album.access),
+                timestamp = gdata.photos.Timestamp(text = str(album.timestamp)),
+                numphotos = gdata.photos.Numphotos(text = str(len(album.photos))),
+                published = atom.Published(text = album.published),
+                updated = atom.Updated(text = album.updated),
+                link = [atom.Link(rel = FEED, href = '%s/data/feed/api/user/default/albumid/%s' % (self.base, album.id)),
+                        atom.Link(rel = 'edit', href = '%s/data/entry/api/user/default/albumid/%s' % (self.base, album.id))],
+                media = gdata.media.Group(thumbnail = [gdata.media.Thumbnail(url = '%s/thumb/%s' % (self.base, album.id), width = '160', height = '160')]))
+        entry.rights = atom.Rights(text = album.access)
+        entry.category.append(atom.Category(scheme = 'http://schemas.google.com/g/2005#kind', term = 'http://schemas.google.com/photos/2007#album'))
+        return entry
+
+    def photo_entry(self, photo):
+        path = 'api/user/default/albumid/%s/photoid/%s' % (photo.album_id, photo.id)
+        entry = gdata.photos.PhotoEntry(
+                title = atom.Title(text = photo.title),
+                gphoto_id = gdata.photos.Id(text = photo.id),
+                albumid = gdata.photos.Albumid(text = photo.album_id),
+                timestamp = gdata.photos.Timestamp(text = str(photo.timestamp)),
+                size = gdata.photos.Size(text = str(len(photo.data))),
+                checksum = gdata.photos.Checksum(text = photo.checksum or ''),
+                published = atom.Published(text = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')),
+                content = atom.Content(content_type = photo.mimetype, src = '%s/media/%s/%s' % (self.base, photo.id, photo.version)),
+                link = [atom.Link(rel = 'edit', href = '%s/data/entry/%s/%s' % (self.base, path, photo.version)),
+                        atom.Link(rel = 'edit-media', href = '%s/data/media/%s/%s' % (self.base, path, photo.version))],
+                media = gdata.media.Group(thumbnail = [gdata.media.Thumbnail(url = '%s/thumb/%s?s=%s' % (self.base, photo.id, s), width = str(s), height = str(s)) for s in (72, 144, 288)]))
+        entry.summary = atom.Summary(text = '')
+        entry.category.append(atom.Category(scheme = 'http://schemas.google.com/g/2005#kind', term = 'http://schemas.google.com/photos/2007#photo'))
+        return entry
+
+    def feed(self, kind, items, query, entry):
+        start = int(query.get('start-index', ['1'])[0])
+        size = int(query.get('max-results', [str(len(items) or 1)])[0])
+        if self.options.page_size:
+            size = min(size, self.options.page_size)
+        feed = gdata.GDataFeed(entry = [entry(i) for i in items[start - 1:start - 1 + size]], total_results = gdata.TotalResults(text = str(len(items))),
+                start_index = gdata.StartIndex(text = str(start)), items_per_page = gdata.ItemsPerPage(text = str(size)))
+        feed.category.append(atom.Category(scheme = 'http://schemas.google.com/g/2005#kind', term = 'http://schemas.google.com/photos/2007#' + kind))
+        if start - 1 + size < len(items):
+            query = dict((k, v[0]) for k, v in query.iteritems())
+            query['start-index'] = str(start + size)
+            feed.link.append(atom.Link(rel = 'next', href = '%s%s?%s' % (self.base, urlparse.urlsplit(self.path).path, '&'.join('%s=%s' % i for i in sorted(query.iteritems())))))
+        return feed
+
+    def find_photo(self, album_id, photo_id):
+        album = store.albums.get(album_id)
+        return album and album.photos.get(photo_id)
+
+    def handle_one_request(self):
+        self.counted = False
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            if self.counted:
+                with store.lock:
+                    store.inflight -= 1
+
+    def prologue(self):
+        store.count('requests')
+        if not self.path.startswith('/_'):
+            with store.lock:
+                store.inflight += 1
+                overloaded = self.options.max_inflight and store.inflight > self.options.max_inflight
+            self.counted = True
+            # Like a server shedding load: answered at once, before the latency
+            if overloaded:
+                store.count('throttled')
+                self.fail(503, 'Too many requests in flight')
+                return False
+        if self.options.latency:
+            time.sleep(self.options.latency / 1000.0)
+        if self.options.error_rate and not self.path.startswith('/_') and random.random() < self.options.error_rate:
+            self.fail(self.options.error_status, 'Injected error')
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.prologue():
+            return
+        url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/_stats':
+            with store.lock:
+                stats = dict(store.stats)
+            return self.send(200, json.dumps(stats), 'application/json')
+        m = re.match(r'/data/feed/api/user/default/?$', url.path)
+        if m:
+            store.count('album_feeds')
+            albums = sorted(store.albums.values(), key = lambda a: a.id)
+            return self.send(200, str(self.feed('user', albums, query, self.album_entry)))
+        m = re.match(r'/data/feed/api/user/default/albumid/(\w+)/?$', url.path)
+        if m:
+            album = store.albums.get(m.group(1))
+            if not album:
+                return self.fail(404, 'No such album')
+            store.count('photo_feeds')
+            photos = sorted(album.photos.values(), key = lambda p: p.id)
+            return self.send(200, str(self.feed('album', photos, query, self.photo_entry)))
+        m = re.match(r'/data/entry/api/user/default/albumid/(\w+)/?$', url.path)
+        if m:
+            album = store.albums.get(m.group(1))
+            if not album:
+                return self.fail(404, 'No such album')
+            store.count('entries')
+            return self.send(200, str(self.album_entry(album)))
+        m = re.match(r'/data/entry/api/user/default/albumid/(\w+)/photoid/(\w+)(?:/\d+)?$', url.path)
+        if m:
+            photo = self.find_photo(m.group(1), m.group(2))
+            if not photo:
+                return self.fail(404, 'No such photo')
+            store.count('entries')
+            return self.send(200, str(self.photo_entry(photo)))
+        m = re.match(r'/(media|thumb)/(\w+)', url.path)
+        if m:
+            photo = None
+            for album in store.albums.values():
+                photo = album.photos.get(m.group(2))
+                if photo:
+                    break
+            if m.group(1) == 'thumb':
+                store.count('thumbnails')
+                etag = '"%s-%s"' % (m.group(2), photo.version if photo else 0)
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send(304)
+                return self.send(200, (photo.data if photo else '')[:4096], 'image/jpeg', {'ETag' : etag})
+            if not photo:
+                return self.fail(404, 'No such photo')
+            store.count('downloads')
+            # From the contents, so it tells versions apart across restarts
+            return self.send_range(photo.data, photo.mimetype, '"%s-%08x"' % (photo.id, zlib.crc32(photo.data) & 0xffffffff))
+        self.fail(404, 'Unknown URL')
+
+    do_HEAD = do_GET
+
+    def send_range(self, data, mimetype, etag):
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if self.headers.get('If-Range', etag) != etag:
+            # Changed since the part the client has, it gets all of it
+            m = None
+        if not m:
+            store.count('media_out', self.send(200, data, mimetype, {'Accept-Ranges' : 'bytes', 'ETag' : etag}, self.options.drop_after))
+            return
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else len(data) - 1
+        if start >= len(data):
+            return self.send(416, '', mimetype, {'Content-Range' : 'bytes */%d' % len(data), 'ETag' : etag})
+        end = min(end, len(data) - 1)
+        store.count('media_out', self.send(206, data[start:end + 1], mimetype, {'Content-Range' : 'bytes %d-%d/%d' % (start, end, len(data)), 'Accept-Ranges' : 'bytes', 'ETag' : etag}, self.options.drop_after))
+
+    def parse_upload(self, body):
+        # Either a multipart/related atom entry plus media, or bare media
+        m = re.search(r'boundary=([^;\s]+)', self.headers.get('Content-Type', ''))
+        if not m:
+            return None, body, self.headers.get('Content-Type')
+        boundary = '--' + m.group(1)
+        parts = body.split('\r\n' + boundary)
+        entry = media = mimetype = None
+        for part in parts[1:] if not body.startswith(boundary) else [body[len(boundary):]] + parts[1:]:
+            if part.startswith('--'):
+                break
+            head, _, data = part.partition('\r\n\r\n')
+            content_type = re.search(r'Content-Type:\s*(\S+)', head, re.I)
+            content_type = content_type and content_type.group(1)
+            if content_type == 'application/atom+xml' and entry is None:
+                entry = gdata.photos.PhotoEntryFromString(data)
+            else:
+                media, mimetype = data, content_type
+        return entry, media, mimetype
+
+    def do_POST(self):
+        if not self.prologue():
+            return
+        body = self.read_body()
+        url = urlparse.urlsplit(self.path)
+        if re.match(r'/data/feed/api/user/default/?$', url.path):
+            entry = gdata.photos.AlbumEntryFromString(body)
+            album = Album(store.new_id(), entry.title.text, int(entry.timestamp.text) if entry.timestamp else int(time.time() * 1000), entry.access.text if entry.access else 'public')
+            store.albums[album.id] = album
+            store.count('albums_created')
+            return self.send(201, str(self.album_entry(album)))
+        m = re.match(r'/data/feed/api/user/default/albumid/(\w+)/?$', url.path)
+        if m:
+            album = store.albums.get(m.group(1))
+            if not album:
+                return self.fail(404, 'No such album')
+            entry, media, mimetype = self.parse_upload(body)
+            if entry is None or media is None:
+                return self.fail(400, 'Expected an entry and media')
+            photo = Photo(store.new_id(), album.id, entry.title.text, int(entry.timestamp.text) if entry.timestamp else int(time.time() * 1000), media, mimetype, entry.checksum.text if entry.checksum else None)
+            album.photos[photo.id] = photo
+            album.touch()
+            store.count('uploads')
+            store.count('media_in', len(media))
+            return self.send(201, str(self.photo_entry(photo)))
+        m = re.match(r'/data/feed/api/user/default/albumid/(\w+)/batch$', url.path)
+        if m:
+            album = store.albums.get(m.group(1))
+            if not album:
+                return self.fail(404, 'No such album')
+            return self.send(200, str(self.batch(album, body)))
+        self.fail(404, 'Unknown URL')
+
+    def batch_entry(self, entry, batch_id, code, reason):
+        entry.extension_elements += [atom.ExtensionElement('id', gdata.BATCH_NAMESPACE, text = batch_id),
+                atom.ExtensionElement('status', gdata.BATCH_NAMESPACE, attributes = {'code' : str(code), 'reason' : reason})]
+        return entry
+
+    def batch(self, album, body):
+        # Only updates, each applied like a PUT of the entry and answered on
+        # its own, with the batch id it was sent with
+        feed = gdata.GDataFeed()
+        store.count('batches')
+        for element in ElementTree.fromstring(body).findall(ATOM + 'entry'):
+            batch_id = element.findtext(BATCH + 'id')
+            operation = element.find(BATCH + 'operation')
+            photo = album.photos.get(element.findtext(PHOTOS + 'id'))
+            if operation is None or operation.get('type') != 'update':
+                feed.entry.append(self.batch_entry(gdata.GDataEntry(), batch_id, 400, 'Only updates are supported'))
+                continue
+            if not photo:
+                feed.entry.append(self.batch_entry(gdata.GDataEntry(), batch_id, 404, 'No such photo'))
+                continue
+            if self.options.error_rate and random.random() < self.options.error_rate:
+                store.count('errors')
+                feed.entry.append(self.batch_entry(self.photo_entry(photo), batch_id, self.options.error_status, 'Injected error'))
+                continue
+            photo.title = element.findtext(ATOM + 'title') or photo.title
+            if element.findtext(PHOTOS + 'timestamp'):
+                photo.timestamp = int(element.findtext(PHOTOS + 'timestamp'))
+            if element.findtext(PHOTOS + 'checksum'):
+                photo.checksum = element.findtext(PHOTOS + 'checksum')
+            photo.version += 1
+            album.touch()
+            store.count('metadata_updates')
+            feed.entry.append(self.batch_entry(self.photo_entry(photo), batch_id, 200, 'Success'))
+        return feed
+
+    def do_PUT(self):
+        if not self.prologue():
+            return
+        body = self.read_body()
+        url = urlparse.urlsplit(self.path)
+        m = re.match(r'/data/(entry|media)/api/user/default/albumid/(\w+)/photoid/(\w+)/(\d+)$', url.path)
+        photo = m and self.find_photo(m.group(2), m.group(3))
+        if not photo:
+            return self.fail(404, 'No such photo')
+        if int(m.group(4)) != photo.version:
+            return self.fail(409, 'Version mismatch')
+        entry, media, mimetype = self.parse_upload(body) if m.group(1) == 'media' else (gdata.photos.PhotoEntryFromString(body), None, None)
+        if entry is not None:
+            photo.title = entry.title.text
+            if entry.timestamp:
+                photo.timestamp = int(entry.timestamp.text)
+            if entry.checksum and entry.checksum.text:
+                photo.checksum = entry.checksum.text
+        if media is not None:
+            photo.data = media
+            photo.mimetype = mimetype
+            store.count('blob_updates')
+            store.count('media_in', len(media))
+        else:
+            store.count('metadata_updates')
+        photo.version += 1
+        store.albums[photo.album_id].touch()
+        self.send(200, str(self.photo_entry(photo)))
+
+    def do_DELETE(self):
+        if not self.prologue():
+            return
+        url = urlparse.urlsplit(self.path)
+        m = re.match(r'/data/entry/api/user/default/albumid/(\w+)(?:/photoid/(\w+)/\d+)?$', url.path)
+        if not m or m.group(1) not in store.albums:
+            return self.fail(404, 'Unknown URL')
+        if m.group(2):
+            if not store.albums[m.group(1)].photos.pop(m.group(2), None):
+                return self.fail(404, 'No such photo')
+            store.albums[m.group(1)].touch()
+            store.count('photos_deleted')
+        else:
+            del store.albums[m.group(1)]
+            store.count('albums_deleted')
+        self.send(200, '')
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Fake Picasa Web Albums server for benchmarks.')
+    parser.add_argument('-p', '--port', type = int, default = 8765)
+    parser.add_argument('--latency', type = float, default = 0, metavar = 'MS', help = 'Delay added to every request')
+    parser.add_argument('--bandwidth', type = float, default = 0, metavar = 'KB', help = 'Transfer rate of every request and response body in KB/s. Default is unlimited.')
+    parser.add_argument('--error-rate', type = float, default = 0, metavar = 'P', help = 'Probability of failing a request')
+    parser.add_argument('--error-status', type = int, default = 500, metavar = 'STATUS', help = 'HTTP status of the injected failures. Default is 500.')
+    parser.add_argument('--max-inflight', type = int, default = 0, metavar = 'N', help = 'Answer 503 to API requests beyond N being served at once. Default is no limit.')
+    parser.add_argument('--page-size', type = int, default = 0, metavar = 'N', help = 'Maximum number of entries in a feed page. Default is no limit.')
+    parser.add_argument('--drop-after', type = int, metavar = 'BYTES', help = 'Close the connection after sending BYTES of every media download. Default is to send them whole.')
+    parser.add_argument('--seed', metavar = 'DIR', help = 'Create an album for every directory with photos under DIR')
+    parser.add_argument('-v', '--verbose', action = 'store_true')
+    options = parser.parse_args()
+
+    if options.seed:
+        store.seed(options.seed)
+    Handler.options = options
+    server = Server(('127.0.0.1', options.port), Handler)
+    print 'Listening on http://127.0.0.1:%d/' % server.server_address[1]
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
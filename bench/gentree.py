@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+
+# Generate a synthetic photo tree to benchmark syncing against.
+#
+#   python bench/gentree.py [-a ALBUMS] [-p PHOTOS] [-s WIDTHxHEIGHT] DIR
+#
+# Every photo is a noise JPEG, so it does not compress, with an EXIF
+# DateTime, DateTimeOriginal and a random Orientation, so --transform rotate
+# has work to do.
+
+import sys, os, struct, random, argparse, time, calendar
+
+import Image
+
+def exif(timestamp, orientation):
+    # A little endian TIFF header with IFD0 holding Orientation, DateTime
+    # and a pointer to an Exif IFD holding DateTimeOriginal
+    date = time.strftime('%Y:%m:%d %H:%M:%S', time.gmtime(timestamp)) + '\x00'
+    ifd0 = 8
+    exif_ifd = ifd0 + 2 + 3 * 12 + 4
+    date0 = exif_ifd + 2 + 12 + 4
+    date1 = date0 + len(date)
+    tiff = 'II*\x00' + struct.pack('<I', ifd0)
+    tiff += struct.pack('<H', 3)
+    tiff += struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0)
+    tiff += struct.pack('<HHII', 0x0132, 2, len(date), date0)
+    tiff += struct.pack('<HHII', 0x8769, 4, 1, exif_ifd)
+    tiff += struct.pack('<I', 0)
+    tiff += struct.pack('<H', 1)
+    tiff += struct.pack('<HHII', 0x9003, 2, len(date), date1)
+    tiff += struct.pack('<I', 0)
+    tiff += date + date
+    return 'Exif\x00\x00' + tiff
+
+# Old PIL only has fromstring, Pillow only frombytes
+frombytes = getattr(Image, 'frombytes', None) or Image.fromstring
+
+def photo(path, size, timestamp, orientation, quality):
+    frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)).save(path + '.tmp', 'JPEG', quality = quality)
+    with open(path + '.tmp', 'rb') as f:
+        data = f.read()
+    app1 = exif(timestamp, orientation)
+    with open(path, 'wb') as f:
+        f.write(data[:2] + '\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + data[2:])
+    os.remove(path + '.tmp')
+    os.utime(path, (timestamp, timestamp))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Generate a synthetic photo tree.')
+    parser.add_argument('-a', '--albums', type = int, default = 10)
+    parser.add_argument('-p', '--photos', type = int, default = 20, help = 'Photos per album')
+    parser.add_argument('-s', '--size', default = '640x480', help = 'Photo size. Default is 640x480.')
+    parser.add_argument('-q', '--quality', type = int, default = 85)
+    parser.add_argument('--seed', type = int, default = 0, help = 'Random seed for orientations and dates')
+    parser.add_argument('path', metavar = 'DIR')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    size = tuple(int(x) for x in args.size.split('x'))
+    base = calendar.timegm((2012, 1, 1, 0, 0, 0))
+    for a in xrange(args.albums):
+        album = os.path.join(args.path, 'album%03d' % a)
+        if not os.path.isdir(album):
+            os.makedirs(album)
+        for p in xrange(args.photos):
+            photo(os.path.join(album, 'IMG_%04d.jpg' % p), size, base + random.randint(0, 365 * 86400), random.choice((1, 1, 1, 3, 6, 8)), args.quality)
+        sys.stdout.write('.')
+        sys.stdout.flush()
+    print
+
+if __name__ == '__main__':
+    main()